@@ -0,0 +1,153 @@
+import logging
+import math
+import os
+import time
+import faiss
+import numpy as np
+
+logger = logging.getLogger('jugalbandi_api')
+
+ANN_INDEX_FILE = "ann.faiss"
+INDEX_PQ_M = int(os.environ.get("INDEX_PQ_M", 64))
+INDEX_HNSW_M = int(os.environ.get("INDEX_HNSW_M", 32))
+INDEX_HNSW_EF_CONSTRUCTION = int(os.environ.get("INDEX_HNSW_EF_CONSTRUCTION", 80))
+INDEX_TARGET_RECALL = float(os.environ.get("INDEX_TARGET_RECALL", 0.95))
+INDEX_EVAL_QUERIES = int(os.environ.get("INDEX_EVAL_QUERIES", 200))
+# Evaluation queries are stored vectors moved by noise of this length, relative to the vector's own norm
+INDEX_EVAL_NOISE = float(os.environ.get("INDEX_EVAL_NOISE", 0.5))
+# Approximate indexes return this many times k candidates, which are then re-ranked by exact distance
+INDEX_RERANK_FACTOR = int(os.environ.get("INDEX_RERANK_FACTOR", 4))
+# Override the search parameters tuned at indexing time; 0 keeps the value stored with the index
+INDEX_NPROBE = int(os.environ.get("INDEX_NPROBE", 0))
+INDEX_EF_SEARCH = int(os.environ.get("INDEX_EF_SEARCH", 0))
+
+RECALL_K = 10
+# k-means needs about this many training vectors per centroid to give useful clusters
+_MIN_POINTS_PER_CENTROID = 39
+_MIN_NLIST = 8
+_SEARCH_PARAMETERS = {"ivf": "nprobe", "ivfpq": "nprobe", "hnsw": "efSearch"}
+_CANDIDATE_VALUES = {"nprobe": [1, 2, 4, 8, 16, 32, 64, 128, 256], "efSearch": [16, 32, 64, 128, 256, 512]}
+
+
+def exact_search(queries, vectors, norms, k):
+    # Squared L2 distances, like faiss.IndexFlatL2, without copying the vectors
+    k = min(k, len(vectors))
+    if k <= 0:
+        return np.empty((len(queries), 0), dtype=np.float32), np.empty((len(queries), 0), dtype=np.int64)
+    distances = norms[None, :] - 2 * (queries @ vectors.T) + (queries ** 2).sum(axis=1)[:, None]
+    indices = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    rows = np.arange(len(queries))[:, None]
+    order = np.argsort(distances[rows, indices], axis=1)
+    indices = indices[rows, order]
+    return distances[rows, indices].astype(np.float32), indices.astype(np.int64)
+
+
+def rerank_search(index, queries, k, vectors, norms):
+    # The approximate index only picks candidates; they are ordered by their exact squared L2 distance to the
+    # stored vectors, so returned scores are comparable to a flat index even for IVF-PQ
+    _, candidates = index.search(queries, max(k, k * INDEX_RERANK_FACTOR))
+    distances = np.full((len(queries), k), np.finfo(np.float32).max, dtype=np.float32)
+    indices = np.full((len(queries), k), -1, dtype=np.int64)
+    for row, query in enumerate(queries):
+        # Sorted positions read the memory-mapped vectors in file order
+        found = np.unique(candidates[row][candidates[row] >= 0])
+        if not len(found):
+            continue
+        exact = norms[found] - 2 * (vectors[found] @ query) + query @ query
+        best = np.argsort(exact)[:k]
+        distances[row, :len(best)] = exact[best]
+        indices[row, :len(best)] = found[best]
+    return distances, indices
+
+
+def _nlist(ntotal):
+    return min(int(4 * math.sqrt(ntotal)), ntotal // _MIN_POINTS_PER_CENTROID)
+
+
+def choose_index_type(index_type, ntotal, dimension):
+    # Falls back to a simpler index when there are too few vectors to train the requested one
+    if index_type == "ivfpq" and (ntotal < 256 * _MIN_POINTS_PER_CENTROID or dimension % INDEX_PQ_M):
+        index_type = "ivf"
+    if index_type == "ivf" and _nlist(ntotal) < _MIN_NLIST:
+        index_type = "flat"
+    return index_type
+
+
+def build_ann_index(vectors, index_type):
+    ntotal, dimension = vectors.shape
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dimension, INDEX_HNSW_M)
+        index.hnsw.efConstruction = INDEX_HNSW_EF_CONSTRUCTION
+    else:
+        quantizer = faiss.IndexFlatL2(dimension)
+        if index_type == "ivf":
+            index = faiss.IndexIVFFlat(quantizer, dimension, _nlist(ntotal))
+        else:
+            index = faiss.IndexIVFPQ(quantizer, dimension, _nlist(ntotal), INDEX_PQ_M, 8)
+        start_time = time.time()
+        index.train(vectors)
+        logger.info(f"Trained {index_type} index with {_nlist(ntotal)} lists in {time.time() - start_time:.1f}s")
+    index.add(vectors)
+    return index
+
+
+def set_search_parameter(index, index_type, value):
+    faiss.ParameterSpace().set_index_parameter(index, _SEARCH_PARAMETERS[index_type], value)
+
+
+def search_parameter_override(index_type):
+    return INDEX_EF_SEARCH if index_type == "hnsw" else INDEX_NPROBE
+
+
+def _search_in_batches(search, queries, batch_size=16):
+    return np.vstack([search(queries[start:start + batch_size], RECALL_K)[1]
+                      for start in range(0, len(queries), batch_size)])
+
+
+def _measure(search, queries, truth):
+    start_time = time.perf_counter()
+    indices = _search_in_batches(search, queries)
+    search_ms = (time.perf_counter() - start_time) * 1000 / len(queries)
+    hits = sum(len(set(found) & set(expected)) for found, expected in zip(indices.tolist(), truth.tolist()))
+    return hits / truth.size, search_ms
+
+
+def evaluate_index(index, index_type, vectors, norms):
+    # Measures recall@10 of the re-ranked search against exact search. A stored vector would find itself, so
+    # the queries are perturbed copies of sampled vectors. For approximate indexes the smallest
+    # nprobe/efSearch reaching INDEX_TARGET_RECALL becomes the default search parameter.
+    rng = np.random.default_rng(0)
+    sample = rng.choice(len(vectors), min(len(vectors), INDEX_EVAL_QUERIES), replace=False)
+    queries = np.array(vectors[np.sort(sample)], dtype=np.float32)
+    noise = rng.standard_normal(queries.shape).astype(np.float32)
+    noise *= INDEX_EVAL_NOISE * np.linalg.norm(queries, axis=1, keepdims=True) / np.linalg.norm(noise, axis=1,
+                                                                                               keepdims=True)
+    queries += noise
+
+    def exact(batch, k):
+        return exact_search(batch, vectors, norms, k)
+
+    def approximate(batch, k):
+        return rerank_search(index, batch, k, vectors, norms)
+
+    truth = _search_in_batches(exact, queries)
+    if index is None:
+        recall, search_ms = _measure(exact, queries, truth)
+        return {"recall_at_10": recall, "search_ms": round(search_ms, 3)}
+
+    parameter = _SEARCH_PARAMETERS[index_type]
+    measurements = []
+    for value in _CANDIDATE_VALUES[parameter]:
+        set_search_parameter(index, index_type, value)
+        recall, search_ms = _measure(approximate, queries, truth)
+        measurements.append({parameter: value, "recall_at_10": recall, "search_ms": round(search_ms, 3)})
+        if recall >= INDEX_TARGET_RECALL:
+            break
+    # Quantized indexes may never reach the target; then take the cheapest setting close to the best recall seen
+    best_recall = max(measurement["recall_at_10"] for measurement in measurements)
+    chosen = next(measurement for measurement in measurements
+                  if measurement["recall_at_10"] >= min(INDEX_TARGET_RECALL, best_recall - 0.01))
+    logger.info(f"Tuned {index_type} index: {parameter}={chosen[parameter]}, recall@10={chosen['recall_at_10']:.3f}, "
+                f"{chosen['search_ms']}ms per query")
+    return {"search_parameter": parameter, "search_parameter_value": chosen[parameter],
+            "recall_at_10": chosen["recall_at_10"], "search_ms": chosen["search_ms"], "measurements": measurements}
@@ -1,41 +1,152 @@
+from google.api_core.exceptions import PreconditionFailed
+from google.auth.transport.requests import AuthorizedSession
 from google.cloud import storage
 from google.oauth2 import service_account
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import json
+import logging
 import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+logger = logging.getLogger('jugalbandi_api')
+
+INDEX_CACHE_DIR = os.environ.get("INDEX_CACHE_DIR", "index_cache")
+INDEX_DISK_CACHE_MAX_BYTES = int(os.environ.get("INDEX_DISK_CACHE_MAX_BYTES", 10 * 1024 * 1024 * 1024))
+# Cache entries used this recently are never evicted; a worker may still be loading them
+INDEX_CACHE_MIN_AGE = int(os.environ.get("INDEX_CACHE_MIN_AGE", 600))
+# Layout of stores published before index manifests; newer versions list their own files in the manifest
+LANGCHAIN_INDEX_FILES = ["index.faiss", "index.pkl"]
+INDEX_MANIFEST_FILE = "index_manifest.json"
+GCS_HTTP_POOL_SIZE = int(os.environ.get("GCS_HTTP_POOL_SIZE", 32))
+# Upload threads shared by every bulk upload of the process, so concurrent uploads cannot multiply them
+GCS_UPLOAD_WORKERS = int(os.environ.get("GCS_UPLOAD_WORKERS", 16))
+GCS_UPLOAD_RETRIES = int(os.environ.get("GCS_UPLOAD_RETRIES", 3))
+
+
+_storage_client = None
+_bucket = None
+_client_lock = threading.Lock()
+_upload_executor = None
+
+
+def get_storage_client():
+    global _storage_client
+    if _storage_client is None:
+        with _client_lock:
+            if _storage_client is None:
+                credentials = service_account.Credentials.from_service_account_file("gcp_credentials.json")
+                credentials = credentials.with_scopes(storage.Client.SCOPE)
+                http = AuthorizedSession(credentials)
+                adapter = HTTPAdapter(pool_connections=GCS_HTTP_POOL_SIZE, pool_maxsize=GCS_HTTP_POOL_SIZE)
+                http.mount("https://", adapter)
+                _storage_client = storage.Client(project=credentials.project_id, credentials=credentials,
+                                                 _http=http)
+    return _storage_client
 
 
 def cloud_authentication():
-    load_dotenv()
-    credentials = service_account.Credentials.from_service_account_file("gcp_credentials.json")
-    storage_client = storage.Client(credentials=credentials)
-    bucket = storage_client.get_bucket(os.environ["BUCKET_NAME"])
-    return bucket
+    global _bucket
+    if _bucket is None:
+        load_dotenv()
+        # client.bucket() builds the handle locally instead of paying a get_bucket round trip
+        bucket = get_storage_client().bucket(os.environ["BUCKET_NAME"])
+        with _client_lock:
+            if _bucket is None:
+                _bucket = bucket
+    return _bucket
 
 
 def upload_file(folder_name, filename):
     bucket = cloud_authentication()
     full_folder_name = "generic_qa/" + str(folder_name) + "/"
-    destination_blob_name = full_folder_name + filename
+    destination_blob_name = full_folder_name + os.path.basename(filename)
     blob = bucket.blob(destination_blob_name)
     blob.upload_from_filename(filename)
 
 
-def read_given_file(uuid_number, file_name):
+def _upload_file_with_retry(folder_name, filename):
+    for attempt in range(GCS_UPLOAD_RETRIES + 1):
+        try:
+            upload_file(folder_name, filename)
+            return os.path.getsize(filename)
+        except Exception as e:
+            if attempt == GCS_UPLOAD_RETRIES:
+                raise
+            delay = min(30, 2 ** attempt) * random.uniform(0.5, 1.5)
+            logger.warning(f"Upload of {filename} failed ({e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def get_upload_executor():
+    global _upload_executor
+    if _upload_executor is None:
+        with _client_lock:
+            if _upload_executor is None:
+                _upload_executor = ThreadPoolExecutor(max_workers=GCS_UPLOAD_WORKERS, thread_name_prefix="gcs-upload")
+    return _upload_executor
+
+
+def bulk_upload_files(folder_name, filenames):
+    # Uploads many local files concurrently over the shared client, retrying each file on its own
+    start_time = time.time()
+    uploaded_bytes = 0
+    failed_files = []
+    executor = get_upload_executor()
+    futures = {executor.submit(_upload_file_with_retry, folder_name, filename): filename for filename in filenames}
+    for future in as_completed(futures):
+        try:
+            uploaded_bytes += future.result()
+        except Exception as e:
+            logger.warning(f"Upload of {futures[future]} failed: {e}")
+            failed_files.append(os.path.basename(futures[future]))
+    elapsed = time.time() - start_time
+    throughput = uploaded_bytes / (1024 * 1024) / elapsed if elapsed > 0 else 0.0
+    logger.info(f"Uploaded {len(filenames) - len(failed_files)}/{len(filenames)} files ({uploaded_bytes} bytes) "
+                f"to {folder_name} in {elapsed:.2f}s ({throughput:.2f} MB/s)")
+    return {"uploaded_files": len(filenames) - len(failed_files), "uploaded_bytes": uploaded_bytes,
+            "seconds": elapsed, "failed_files": failed_files}
+
+
+def read_given_file(uuid_number, file_name, destination=None):
     bucket = cloud_authentication()
     folder_name = "generic_qa/" + uuid_number + "/" + file_name
     blobs = list(bucket.list_blobs(prefix=folder_name))
     if len(blobs):
         for blob in blobs:
-            blob.download_to_filename(file_name)
+            blob.download_to_filename(destination or file_name)
     return len(blobs)
 
 
+def _document_blobs(bucket, folder_name):
+    blobs = list(bucket.list_blobs(prefix=folder_name))
+    return [blob for blob in blobs if ("index.json" not in blob.name)
+            and ("index.faiss" not in blob.name) and ("index.pkl" not in blob.name)
+            and (INDEX_MANIFEST_FILE not in blob.name) and ("/index_versions/" not in blob.name)]
+
+
+def list_document_files(uuid_number):
+    folder_name = "generic_qa/" + uuid_number + "/"
+    return [str(blob.name).replace(folder_name, "") for blob in _document_blobs(cloud_authentication(), folder_name)]
+
+
+def delete_files(uuid_number, file_names):
+    bucket = cloud_authentication()
+    blobs = [bucket.blob("generic_qa/" + uuid_number + "/" + file_name) for file_name in file_names]
+    # Blobs that are already gone are ignored
+    bucket.delete_blobs(blobs, on_error=lambda blob: None)
+
+
 def read_files(uuid_number):
     bucket = cloud_authentication()
     folder_name = "generic_qa/" + uuid_number + "/"
-    blobs = list(bucket.list_blobs(prefix=folder_name))
-    blobs = [blob for blob in blobs if ("index.json" not in blob.name)
-             and ("index.faiss" not in blob.name) and ("index.pkl" not in blob.name)]
+    blobs = _document_blobs(bucket, folder_name)
     if len(blobs):
         destination_folder = uuid_number + "/"
         if not os.path.exists(destination_folder):
@@ -46,33 +157,156 @@ def read_files(uuid_number):
     return len(blobs)
 
 
+def _resolve_index(bucket, uuid_number):
+    # The published index of a uuid is the version named by its manifest. Stores indexed before
+    # manifests existed keep index.faiss/index.pkl at the folder root and are versioned by generation.
+    folder_name = "generic_qa/" + uuid_number + "/"
+    manifest_blob = bucket.get_blob(folder_name + INDEX_MANIFEST_FILE)
+    if manifest_blob is not None:
+        return "manifest-" + str(manifest_blob.generation), manifest_blob, None
+    blobs = list(bucket.list_blobs(prefix=folder_name + "index."))
+    blobs = [blob for blob in blobs if str(blob.name).replace(folder_name, "") in LANGCHAIN_INDEX_FILES]
+    if len(blobs) != len(LANGCHAIN_INDEX_FILES):
+        return None
+    blobs.sort(key=lambda blob: blob.name)
+    return "legacy-" + "-".join(str(blob.generation) for blob in blobs), None, blobs
+
+
+def get_index_version(uuid_number):
+    resolved = _resolve_index(cloud_authentication(), uuid_number)
+    return resolved[0] if resolved is not None else None
+
+
 def read_langchain_index_files(uuid_number):
-    if (os.path.isfile(uuid_number + "/" + "index.faiss") and os.path.isfile(uuid_number + "/" + "index.faiss")): 
-        return 2
-    else:
-        bucket = cloud_authentication()
-        folder_name = "generic_qa/" + uuid_number + "/"
-        blobs = list(bucket.list_blobs(prefix=folder_name))
-        blobs = [blob for blob in blobs if ("index.faiss" in blob.name) or ("index.pkl" in blob.name)]
-        print("Reading the blobs", blobs)
-        if len(blobs) == 2:
-            destination_folder = uuid_number + "/"
-            if not os.path.exists(destination_folder):
-                os.makedirs(destination_folder)
-            for blob in blobs:
-                file_name = destination_folder + str(blob.name).replace(folder_name, "")
-                print("Writing the blob to file", file_name)
-                blob.download_to_filename(file_name)
-        return len(blobs)
-
-
-def give_public_url(filename):
     bucket = cloud_authentication()
-    file_name = "generic_qa/output_audio_files/" + filename
-    blobs = bucket.list_blobs(prefix=file_name)
-    for blob in blobs:
-        blob.make_public()
-        return blob.public_url
+    resolved = _resolve_index(bucket, uuid_number)
+    if resolved is None:
+        return None
+    # A cache entry is named after the index version it was downloaded from,
+    # so an unchanged index is served from disk and a re-published one gets a new entry
+    version, manifest_blob, blobs = resolved
+    uuid_cache_folder = os.path.join(INDEX_CACHE_DIR, uuid_number)
+    destination_folder = os.path.join(uuid_cache_folder, version)
+    if os.path.isdir(destination_folder):
+        os.utime(destination_folder)
+        return destination_folder
+
+    if manifest_blob is not None:
+        manifest = json.loads(manifest_blob.download_as_bytes(if_generation_match=manifest_blob.generation))
+        blobs = [bucket.blob("generic_qa/" + uuid_number + "/" + manifest["folder"] + "/" + file_name)
+                 for file_name in manifest["files"]]
+    os.makedirs(uuid_cache_folder, exist_ok=True)
+    temp_folder = tempfile.mkdtemp(prefix=".download-", dir=uuid_cache_folder)
+    try:
+        for blob in blobs:
+            file_name = os.path.join(temp_folder, os.path.basename(blob.name))
+            print("Writing the blob to file", file_name)
+            blob.download_to_filename(file_name, if_generation_match=blob.generation)
+        try:
+            os.rename(temp_folder, destination_folder)
+        except OSError:
+            # Another worker finished downloading the same version first
+            if not os.path.isdir(destination_folder):
+                raise
+    finally:
+        shutil.rmtree(temp_folder, ignore_errors=True)
+    evict_index_cache(keep=destination_folder)
+    return destination_folder
+
+
+def publish_index_version(uuid_number, filenames, expected_version=None):
+    # Uploads the index files under a new immutable version folder and then switches the manifest to it.
+    # The manifest write is conditional on the version the caller started from, so a concurrent publish
+    # raises google.api_core.exceptions.PreconditionFailed instead of being silently overwritten.
+    version_folder = "index_versions/" + time.strftime("%Y%m%d-%H%M%S") + "-" + uuid.uuid4().hex[:8]
+    upload_summary = bulk_upload_files(uuid_number + "/" + version_folder, filenames)
+    bucket = cloud_authentication()
+    if upload_summary["failed_files"]:
+        # A version that no manifest will ever name is removed straight away
+        _delete_index_versions(bucket, uuid_number, [version_folder])
+        return upload_summary
+    manifest = {
+        "folder": version_folder,
+        "files": [os.path.basename(filename) for filename in filenames],
+        "published_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    }
+    expected_generation = 0
+    if expected_version is not None and expected_version.startswith("manifest-"):
+        expected_generation = int(expected_version[len("manifest-"):])
+    manifest_blob = bucket.blob("generic_qa/" + uuid_number + "/" + INDEX_MANIFEST_FILE)
+    try:
+        manifest_blob.upload_from_string(json.dumps(manifest), content_type="application/json",
+                                         if_generation_match=expected_generation)
+    except PreconditionFailed:
+        _delete_index_versions(bucket, uuid_number, [version_folder])
+        raise
+    prune_index_versions(bucket, uuid_number, version_folder)
+    return upload_summary
+
+
+def _index_version_folders(bucket, uuid_number):
+    prefix = "generic_qa/" + uuid_number + "/"
+    folders = {}
+    for blob in bucket.list_blobs(prefix=prefix + "index_versions/"):
+        folder = "/".join(str(blob.name)[len(prefix):].split("/")[:2])
+        folders.setdefault(folder, []).append(blob)
+    return folders
+
+
+def _delete_index_versions(bucket, uuid_number, version_folders):
+    folders = _index_version_folders(bucket, uuid_number)
+    blobs = [blob for version_folder in version_folders for blob in folders.get(version_folder, [])]
+    bucket.delete_blobs(blobs, on_error=lambda blob: None)
+
+
+def prune_index_versions(bucket, uuid_number, current_folder):
+    # Deletes superseded index versions. The newest one before the current version is kept, since other
+    # workers may still be downloading it; version folder names start with their creation time.
+    folders = _index_version_folders(bucket, uuid_number)
+    superseded = sorted(folder for folder in folders if folder != current_folder)[:-1]
+    blobs = [blob for folder in superseded for blob in folders[folder]]
+    if blobs:
+        bucket.delete_blobs(blobs, on_error=lambda blob: None)
+        logger.info(f"Deleted {len(superseded)} superseded index versions of {uuid_number}")
+
+
+def evict_index_cache(keep=None):
+    entries = []
+    total_size = 0
+    for uuid_number in os.listdir(INDEX_CACHE_DIR):
+        uuid_cache_folder = os.path.join(INDEX_CACHE_DIR, uuid_number)
+        if not os.path.isdir(uuid_cache_folder):
+            continue
+        for version in os.listdir(uuid_cache_folder):
+            if version.startswith("."):
+                continue
+            version_folder = os.path.join(uuid_cache_folder, version)
+            try:
+                size = sum(entry.stat().st_size for entry in os.scandir(version_folder))
+                entries.append((os.stat(version_folder).st_mtime, size, version_folder))
+            except OSError:
+                continue
+            total_size += size
+    entries.sort()
+    now = time.time()
+    for accessed_at, size, version_folder in entries:
+        if total_size <= INDEX_DISK_CACHE_MAX_BYTES:
+            break
+        # read_langchain_index_files touches an entry before handing it out, so a recent mtime means
+        # some worker may be loading it right now
+        if version_folder == keep or now - accessed_at < INDEX_CACHE_MIN_AGE:
+            continue
+        shutil.rmtree(version_folder, ignore_errors=True)
+        total_size -= size
+
+
+def upload_output_audio(audio_content):
+    # Uploads the MP3 bytes under a name of their own, so concurrent voice answers never share a file
+    bucket = cloud_authentication()
+    blob = bucket.blob(f"generic_qa/output_audio_files/audio-output-{uuid.uuid4()}.mp3")
+    blob.upload_from_string(audio_content, content_type="audio/mpeg")
+    blob.make_public()
+    return blob.public_url
 
 
 def check_bucket_cors_policy():
@@ -0,0 +1,34 @@
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# Maximum number of in-flight blocking calls per external dependency, per worker
+CONCURRENCY_LIMITS = {
+    "openai": int(os.environ.get("OPENAI_CONCURRENCY", 32)),
+    "gcs": int(os.environ.get("GCS_CONCURRENCY", 16)),
+    "translation": int(os.environ.get("TRANSLATION_CONCURRENCY", 16)),
+    "indexing": int(os.environ.get("INDEXING_CONCURRENCY", 2)),
+    # TF-IDF title search is CPU-bound, so it is limited separately from the network-bound dependencies
+    "tfidf": int(os.environ.get("TFIDF_CONCURRENCY", 4)),
+    # Response cache lookups may wait on the node-wide SQLite file
+    "cache": int(os.environ.get("RESPONSE_CACHE_CONCURRENCY", 8)),
+}
+
+_executor = ThreadPoolExecutor(max_workers=sum(CONCURRENCY_LIMITS.values()),
+                               thread_name_prefix="blocking")
+_semaphores = {}
+
+
+def _get_semaphore(dependency):
+    semaphore = _semaphores.get(dependency)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(CONCURRENCY_LIMITS[dependency])
+        _semaphores[dependency] = semaphore
+    return semaphore
+
+
+async def run_blocking(dependency, func, *args, **kwargs):
+    async with _get_semaphore(dependency):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
@@ -1,7 +1,55 @@
+import asyncio
 import asyncpg
+import hashlib
+import logging
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
 import pytz
+from cachetools import TTLCache
+
+logger = logging.getLogger('jugalbandi_api')
+
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+LOG_BATCH_SIZE = int(os.environ.get("LOG_BATCH_SIZE", 500))
+LOG_FLUSH_INTERVAL = float(os.environ.get("LOG_FLUSH_INTERVAL", 1.0))
+# What happens to a log row when the queue is full: drop_oldest, drop_newest or block (wait for space)
+LOG_OVERFLOW_POLICY = os.environ.get("LOG_OVERFLOW_POLICY", "drop_oldest")
+
+LOG_TABLE_COLUMNS = {
+    "qa_logs": ["model_name", "uuid_number", "query", "paraphrased_query", "response", "source_text",
+                "error_message", "created_at"],
+    "document_store_logs": ["description", "uuid_number", "documents_list", "error_message", "created_at"],
+    "qa_voice_logs": ["uuid_number", "input_language", "output_format", "query", "query_in_english",
+                      "paraphrased_query", "response", "response_in_english", "audio_output_link", "source_text",
+                      "error_message", "created_at"],
+    "sb_qa_logs": ["model_name", "uuid_number", "question_id", "query", "paraphrased_query", "response",
+                   "source_text", "error_message", "created_at", "source_chunk_ids", "source_chunk_hashes",
+                   "source_scores"],
+    "document_chunks": ["uuid_number", "chunk_id", "content_hash", "content", "created_at"],
+}
+# Tables whose rows are counted as answered queries in usage_rollups
+USAGE_TABLES = {"qa_logs", "qa_voice_logs", "sb_qa_logs"}
+# model_name of a logged answer served from a response cache; such rows count as cache hits, not queries
+CACHED_ANSWER_MODEL = "cache"
+# Rows of these tables may already exist and are written with INSERT ... ON CONFLICT DO NOTHING instead of COPY
+LOG_DEDUPLICATED_TABLES = {"document_chunks"}
+# Errors that say nothing about the rows being written; such rows are kept and retried on the next flush
+TRANSIENT_LOG_ERRORS = (OSError, asyncio.TimeoutError, asyncpg.InterfaceError,
+                        asyncpg.exceptions.PostgresConnectionError, asyncpg.exceptions.CannotConnectNowError,
+                        asyncpg.exceptions.InsufficientResourcesError)
+# Answers are logged through the queue, so feedback or a /source-chunks lookup can arrive on any worker
+# before the answer row is written; the lookup waits up to this many seconds for it
+ANSWER_LOOKUP_WAIT_SECONDS = float(os.environ.get("ANSWER_LOOKUP_WAIT_SECONDS", 5))
+ANSWER_LOOKUP_POLL_SECONDS = 0.25
+# How many chunk keys each worker remembers as already stored, to avoid re-sending their text
+KNOWN_CHUNKS_SIZE = int(os.environ.get("KNOWN_CHUNKS_SIZE", 100000))
+# Seconds a chunk stays known. Retention only deletes chunks no log row newer than the cutoff refers to,
+# so a chunk written or re-sent this recently is never missing from document_chunks.
+KNOWN_CHUNKS_TTL = int(os.environ.get("KNOWN_CHUNKS_TTL", 24 * 60 * 60))
+# Each worker touches the indexing jobs it is running this often; queued or running jobs untouched for
+# INDEXING_JOB_STALE_SECONDS belong to a worker that stopped and are marked failed
+INDEXING_JOB_HEARTBEAT_SECONDS = int(os.environ.get("INDEXING_JOB_HEARTBEAT_SECONDS", 30))
+INDEXING_JOB_STALE_SECONDS = int(os.environ.get("INDEXING_JOB_STALE_SECONDS", 300))
 
 
 async def create_engine(timeout=60):
@@ -14,13 +62,299 @@ async def create_engine(timeout=60):
         max_size=20,
         min_size=10
     )
-    await create_schema(engine)
+    await apply_migrations(engine)
+    await maintain_log_partitions(engine)
     return engine
 
 
-async def create_schema(engine):
+# Log rows are queued in memory and written by a background task in batches with COPY,
+# so a request never waits on the database to record what it did.
+class LogWriter:
+    def __init__(self, engine, max_size=LOG_QUEUE_SIZE, batch_size=LOG_BATCH_SIZE,
+                 flush_interval=LOG_FLUSH_INTERVAL, overflow_policy=LOG_OVERFLOW_POLICY):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow_policy = overflow_policy
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self._queue = asyncio.Queue(max_size)
+        # table -> record lists left over from a flush that hit a transient error
+        self._retry = {}
+        # (uuid_number, day) -> [queries, errors, cache hits] not yet added to usage_rollups
+        self._usage = {}
+        self._batch_ready = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+        if self._retry:
+            logger.error(f"{self._retry_size()} log rows could not be written before shutdown")
+
+    async def log(self, table, record):
+        await self._enqueue(table, record)
+
+    def _written(self, table, records):
+        # Usage is counted from the rows actually written, so dropped or rejected rows are not counted
+        self.written += len(records)
+        if table == "document_chunks":
+            # Chunks are known only once they are stored; queued rows may still be dropped, so they are sent again
+            for uuid_number, chunk_id, content_hash, _, _ in records:
+                _known_chunks[(uuid_number, chunk_id, content_hash)] = True
+        if table in USAGE_TABLES:
+            columns = LOG_TABLE_COLUMNS[table]
+            for record in records:
+                usage = self._usage_counts(record[columns.index("uuid_number")],
+                                           record[columns.index("created_at")].date())
+                if "model_name" in columns and record[columns.index("model_name")] == CACHED_ANSWER_MODEL:
+                    usage[2] += 1
+                    continue
+                usage[0] += 1
+                if record[columns.index("error_message")] is not None:
+                    usage[1] += 1
+
+    async def _enqueue(self, table, record):
+        if self.overflow_policy == "block":
+            await self._queue.put((table, record))
+        else:
+            try:
+                self._queue.put_nowait((table, record))
+            except asyncio.QueueFull:
+                if self.overflow_policy == "drop_oldest":
+                    self._queue.get_nowait()
+                    self._queue.put_nowait((table, record))
+                self.dropped += 1
+                if self.dropped % 1000 == 1:
+                    logger.warning(f"Log queue is full, {self.dropped} log rows dropped so far")
+        if self._queue.qsize() >= self.batch_size:
+            self._batch_ready.set()
+
+    def record_cache_hit(self, uuid_number):
+        self._usage_counts(uuid_number, datetime.now(pytz.UTC).date())[2] += 1
+
+    def _usage_counts(self, uuid_number, day):
+        return self._usage.setdefault((uuid_number, day), [0, 0, 0])
+
+    async def flush(self):
+        async with self._flush_lock:
+            while self._retry or not self._queue.empty():
+                batch = self._retry or self._take_batch()
+                try:
+                    async with self.engine.acquire() as connection:
+                        for table, chunks in batch.items():
+                            await self._write_chunks(connection, table, chunks)
+                    self._retry = {}
+                except Exception as e:
+                    # The rows themselves are fine; whatever was not written is retried on the next flush
+                    self._retry = {table: chunks for table, chunks in batch.items() if chunks}
+                    logger.warning(f"Writing log rows failed, {self._retry_size()} rows kept for the next flush: {e}")
+                    break
+            if self._usage:
+                usage, self._usage = self._usage, {}
+                try:
+                    async with self.engine.acquire() as connection:
+                        await connection.executemany(
+                            '''
+                            INSERT INTO usage_rollups (uuid_number, day, query_count, error_count, cache_hits)
+                            VALUES ($1, $2, $3, $4, $5)
+                            ON CONFLICT (uuid_number, day) DO UPDATE SET
+                                query_count = usage_rollups.query_count + EXCLUDED.query_count,
+                                error_count = usage_rollups.error_count + EXCLUDED.error_count,
+                                cache_hits = usage_rollups.cache_hits + EXCLUDED.cache_hits
+                            ''', [(uuid_number, day, *counts) for (uuid_number, day), counts in usage.items()])
+                except Exception as e:
+                    # The counts are added back and written with the next flush
+                    for key, counts in usage.items():
+                        pending = self._usage.setdefault(key, [0, 0, 0])
+                        for i, count in enumerate(counts):
+                            pending[i] += count
+                    logger.warning(f"Updating usage rollups for {len(usage)} stores failed: {e}")
+
+    def _take_batch(self):
+        # table -> list of record lists; _write_chunks splits a list the database rejects
+        batch = {}
+        count = 0
+        while count < self.batch_size and not self._queue.empty():
+            table, record = self._queue.get_nowait()
+            batch.setdefault(table, [[]])[0].append(record)
+            count += 1
+        return batch
+
+    async def _write_chunks(self, connection, table, chunks):
+        # Consumes chunks in place. A COPY the server rejects is split in halves until the offending rows
+        # are isolated, so one bad row does not take the rest of its batch with it.
+        while chunks:
+            records = chunks.pop()
+            try:
+                await self._write(connection, table, records)
+                self._written(table, records)
+            except TRANSIENT_LOG_ERRORS:
+                chunks.append(records)
+                raise
+            except Exception as e:
+                if len(records) == 1:
+                    self.failed += 1
+                    logger.error(f"Dropping a {table} log row the database rejects: {e}")
+                else:
+                    middle = len(records) // 2
+                    chunks.extend([records[middle:], records[:middle]])
+
+    async def _write(self, connection, table, records):
+        columns = LOG_TABLE_COLUMNS[table]
+        if table in LOG_DEDUPLICATED_TABLES:
+            await connection.executemany(
+                f"INSERT INTO {table} ({', '.join(columns)}) "
+                f"VALUES ({', '.join(f'${i + 1}' for i in range(len(columns)))}) "
+                f"ON CONFLICT DO NOTHING", records)
+        else:
+            await connection.copy_records_to_table(table, records=records, columns=columns)
+
+    def _retry_size(self):
+        return sum(len(records) for chunks in self._retry.values() for records in chunks)
+
+    def stats(self):
+        return {"queued": self._queue.qsize(), "retrying": self._retry_size(), "written": self.written,
+                "dropped": self.dropped, "failed": self.failed, "overflow_policy": self.overflow_policy}
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._batch_ready.clear()
+            await self.flush()
+
+
+LOG_PARTITIONED_TABLES = ["qa_logs", "qa_voice_logs", "sb_qa_logs"]
+# Monthly partitions are created this many months ahead of the current one
+LOG_PARTITIONS_AHEAD = int(os.environ.get("LOG_PARTITIONS_AHEAD", 3))
+# Partitions entirely older than this many months are dropped; 0 keeps every partition
+LOG_RETENTION_MONTHS = int(os.environ.get("LOG_RETENTION_MONTHS", 0))
+LOG_PARTITION_MAINTENANCE_SECONDS = int(os.environ.get("LOG_PARTITION_MAINTENANCE_SECONDS", 6 * 60 * 60))
+PARTITION_MAINTENANCE_LOCK_ID = 7315430
+
+
+def month_start(day, months=0):
+    month_index = day.year * 12 + day.month - 1 + months
+    return datetime(month_index // 12, month_index % 12 + 1, 1, tzinfo=pytz.UTC)
+
+
+async def partition_log_tables(connection):
+    # Turns each log table into a table range-partitioned by month on created_at. The existing heap is
+    # attached as-is as the partition of everything before next month, named <table>_before_<YYYYMM>,
+    # so no rows are copied; the monthly partitions created by maintain_log_partitions follow it.
+    # Its primary key on id alone is replaced with the (id, created_at) key every partition needs.
+    next_month = month_start(datetime.now(pytz.UTC), 1)
+    for table in LOG_PARTITIONED_TABLES:
+        legacy = f"{table}_before_{next_month:%Y%m}"
+        await connection.execute(f'''
+            ALTER TABLE {table} RENAME TO {legacy};
+            ALTER TABLE {legacy} DROP CONSTRAINT {table}_pkey;
+            ALTER TABLE {legacy} ADD CONSTRAINT {legacy}_pkey PRIMARY KEY (id, created_at);
+            ALTER INDEX IF EXISTS {table}_uuid_created_at_idx RENAME TO {legacy}_uuid_created_at_idx;
+            ALTER INDEX IF EXISTS {table}_created_at_idx RENAME TO {legacy}_created_at_idx;
+            CREATE TABLE {table} (LIKE {legacy} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)
+                PARTITION BY RANGE (created_at);
+            ALTER TABLE {table} ADD PRIMARY KEY (id, created_at);
+            ALTER SEQUENCE {table}_id_seq OWNED BY {table}.id;
+            CREATE INDEX {table}_uuid_created_at_idx ON {table} (uuid_number, created_at);
+            CREATE INDEX {table}_created_at_idx ON {table} USING BRIN (created_at);
+        ''')
+        if table == "sb_qa_logs":
+            await connection.execute(f'''
+                ALTER INDEX IF EXISTS sb_qa_logs_question_id_idx RENAME TO {legacy}_question_id_idx;
+                CREATE INDEX sb_qa_logs_question_id_idx ON sb_qa_logs (question_id);
+            ''')
+        await connection.execute(
+            f"ALTER TABLE {table} ATTACH PARTITION {legacy} FOR VALUES FROM (MINVALUE) TO ('{next_month.isoformat()}')")
+
+
+async def maintain_log_partitions(engine):
+    # Creates the coming monthly partitions and drops the ones past LOG_RETENTION_MONTHS.
+    # Only one worker does it at a time; the others skip the round.
+    now = datetime.now(pytz.UTC)
     async with engine.acquire() as connection:
-        await connection.execute('''
+        if not await connection.fetchval("SELECT pg_try_advisory_lock($1)", PARTITION_MAINTENANCE_LOCK_ID):
+            return
+        try:
+            for table in LOG_PARTITIONED_TABLES:
+                for months in range(LOG_PARTITIONS_AHEAD + 1):
+                    start, end = month_start(now, months), month_start(now, months + 1)
+                    try:
+                        await connection.execute(
+                            f"CREATE TABLE IF NOT EXISTS {table}_{start:%Y%m} PARTITION OF {table} "
+                            f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')")
+                    except asyncpg.exceptions.InvalidObjectDefinitionError:
+                        # The month is still covered by the partition the table was converted from
+                        pass
+                if LOG_RETENTION_MONTHS > 0:
+                    await _drop_expired_partitions(connection, table, month_start(now, -LOG_RETENTION_MONTHS))
+            if LOG_RETENTION_MONTHS > 0:
+                await _delete_expired_chunks(connection, month_start(now, -LOG_RETENTION_MONTHS))
+        finally:
+            await connection.execute("SELECT pg_advisory_unlock($1)", PARTITION_MAINTENANCE_LOCK_ID)
+
+
+async def _drop_expired_partitions(connection, table, cutoff):
+    partitions = await connection.fetch(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = $1::regclass",
+        table)
+    for partition in partitions:
+        name = partition["relname"]
+        suffix = name[len(table) + 1:]
+        if suffix.startswith("before_"):
+            end = datetime.strptime(suffix[len("before_"):], "%Y%m").replace(tzinfo=pytz.UTC)
+        elif suffix.isdigit():
+            end = month_start(datetime.strptime(suffix, "%Y%m"), 1)
+        else:
+            continue
+        if end <= cutoff:
+            await connection.execute(f"DROP TABLE {name}")
+            logger.info(f"Dropped log partition {name} past the {LOG_RETENTION_MONTHS} month retention")
+
+
+async def _delete_expired_chunks(connection, cutoff):
+    # Chunks stored before the cutoff are deleted unless a retained answer still refers to them
+    result = await connection.execute(
+        '''
+        DELETE FROM document_chunks c
+        WHERE c.created_at < $1 AND NOT EXISTS (
+            SELECT 1 FROM sb_qa_logs l,
+                unnest(l.source_chunk_ids, l.source_chunk_hashes) AS s(chunk_id, content_hash)
+            WHERE l.created_at >= $1 AND l.uuid_number = c.uuid_number
+                AND s.chunk_id = c.chunk_id AND s.content_hash = c.content_hash
+        )
+        ''', cutoff)
+    logger.info(f"Deleted expired document chunks: {result}")
+
+
+async def run_log_partition_maintenance(engine):
+    # The first round runs in create_engine, so that the current month always has a partition
+    while True:
+        await asyncio.sleep(LOG_PARTITION_MAINTENANCE_SECONDS)
+        try:
+            await maintain_log_partitions(engine)
+        except Exception as e:
+            logger.exception(f"Log partition maintenance failed: {e}")
+
+
+# Numbered schema migrations, applied in order and exactly once per database. New schema changes are
+# appended here with the next version number; an applied migration must never be edited.
+# A migration is either SQL or a coroutine function taking the connection.
+MIGRATIONS = [
+    (1, "create log and job tables", '''
             CREATE TABLE IF NOT EXISTS qa_logs (
                 id SERIAL PRIMARY KEY,
                 model_name TEXT DEFAULT 'langchain',
@@ -69,56 +403,279 @@ async def create_schema(engine):
                 downvotes INTEGER DEFAULT 0,
                 created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
             );
-        ''')
+            CREATE TABLE IF NOT EXISTS indexing_jobs (
+                uuid_number TEXT PRIMARY KEY,
+                description TEXT,
+                documents_list TEXT[],
+                status TEXT,
+                stage TEXT,
+                error_message TEXT,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            );
+        '''),
+    (2, "index feedback lookups and per-uuid time-range queries", '''
+            CREATE INDEX IF NOT EXISTS sb_qa_logs_question_id_idx ON sb_qa_logs (question_id);
+            CREATE INDEX IF NOT EXISTS qa_logs_uuid_created_at_idx ON qa_logs (uuid_number, created_at);
+            CREATE INDEX IF NOT EXISTS qa_voice_logs_uuid_created_at_idx ON qa_voice_logs (uuid_number, created_at);
+            CREATE INDEX IF NOT EXISTS sb_qa_logs_uuid_created_at_idx ON sb_qa_logs (uuid_number, created_at);
+            CREATE INDEX IF NOT EXISTS document_store_logs_uuid_created_at_idx
+                ON document_store_logs (uuid_number, created_at);
+            CREATE INDEX IF NOT EXISTS qa_logs_created_at_idx ON qa_logs USING BRIN (created_at);
+            CREATE INDEX IF NOT EXISTS qa_voice_logs_created_at_idx ON qa_voice_logs USING BRIN (created_at);
+            CREATE INDEX IF NOT EXISTS sb_qa_logs_created_at_idx ON sb_qa_logs USING BRIN (created_at);
+        '''),
+    (3, "partition log tables by month", partition_log_tables),
+    (4, "store answer source chunks once and reference them from sb_qa_logs", '''
+            CREATE TABLE IF NOT EXISTS document_chunks (
+                uuid_number TEXT NOT NULL,
+                chunk_id TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                content TEXT NOT NULL,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                PRIMARY KEY (uuid_number, chunk_id, content_hash)
+            );
+            ALTER TABLE sb_qa_logs
+                ADD COLUMN IF NOT EXISTS source_chunk_ids TEXT[],
+                ADD COLUMN IF NOT EXISTS source_chunk_hashes TEXT[],
+                ADD COLUMN IF NOT EXISTS source_scores REAL[];
+        '''),
+    (5, "per uuid daily usage and feedback rollups", '''
+            CREATE TABLE IF NOT EXISTS usage_rollups (
+                uuid_number TEXT NOT NULL,
+                day DATE NOT NULL,
+                query_count BIGINT NOT NULL DEFAULT 0,
+                error_count BIGINT NOT NULL DEFAULT 0,
+                upvotes BIGINT NOT NULL DEFAULT 0,
+                downvotes BIGINT NOT NULL DEFAULT 0,
+                cache_hits BIGINT NOT NULL DEFAULT 0,
+                PRIMARY KEY (uuid_number, day)
+            );
+            CREATE INDEX IF NOT EXISTS usage_rollups_day_idx ON usage_rollups (day);
+        '''),
+]
+# Serializes migrations between workers starting at the same time
+MIGRATION_LOCK_ID = 7315429
+
+
+async def apply_migrations(engine):
+    async with engine.acquire() as connection:
+        await connection.execute("SELECT pg_advisory_lock($1)", MIGRATION_LOCK_ID)
+        try:
+            await connection.execute('''
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT,
+                    applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                )
+            ''')
+            current_version = await connection.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+            for version, description, statements in MIGRATIONS:
+                if version <= current_version:
+                    continue
+                async with connection.transaction():
+                    if callable(statements):
+                        await statements(connection)
+                    else:
+                        await connection.execute(statements)
+                    await connection.execute("INSERT INTO schema_migrations (version, description) VALUES ($1, $2)",
+                                             version, description)
+                logger.info(f"Applied database migration {version}: {description}")
+        finally:
+            await connection.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK_ID)
 
 
-async def insert_qa_logs(engine, model_name, uuid_number, query, paraphrased_query, response, source_text,
+async def insert_qa_logs(log_writer, model_name, uuid_number, query, paraphrased_query, response, source_text,
                          error_message):
+    await log_writer.log("qa_logs", (model_name, uuid_number, query, paraphrased_query, response, source_text,
+                                     error_message, datetime.now(pytz.UTC)))
+
+
+async def insert_document_store_logs(log_writer, description, uuid_number, documents_list, error_message):
+    await log_writer.log("document_store_logs", (description, uuid_number, documents_list, error_message,
+                                                 datetime.now(pytz.UTC)))
+
+
+async def insert_qa_voice_logs(log_writer, uuid_number, input_language, output_format, query, query_in_english,
+                               paraphrased_query, response, response_in_english, audio_output_link, source_text,
+                               error_message):
+    await log_writer.log("qa_voice_logs", (uuid_number, input_language, output_format, query, query_in_english,
+                                           paraphrased_query, response, response_in_english, audio_output_link,
+                                           source_text, error_message, datetime.now(pytz.UTC)))
+
+
+def chunk_content_hash(content):
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+_known_chunks = TTLCache(maxsize=KNOWN_CHUNKS_SIZE, ttl=KNOWN_CHUNKS_TTL)
+
+
+async def insert_sb_qa_logs(log_writer, model_name, uuid_number, question_id, query, paraphrased_query, response,
+                            source_text, error_message, source_chunks=None):
+    # source_chunks is a list of (chunk_id, content, score). The text of a chunk goes to document_chunks
+    # until this worker has stored it once; the log row only keeps the chunk ids, hashes and scores.
+    created_at = datetime.now(pytz.UTC)
+    chunk_ids, chunk_hashes, scores = None, None, None
+    chunk_rows = []
+    if source_chunks:
+        chunk_ids, chunk_hashes, scores = [], [], []
+        for chunk_id, content, score in source_chunks:
+            content_hash = chunk_content_hash(content)
+            chunk_ids.append(chunk_id)
+            chunk_hashes.append(content_hash)
+            scores.append(score)
+            if (uuid_number, chunk_id, content_hash) not in _known_chunks:
+                chunk_rows.append((uuid_number, chunk_id, content_hash, content, created_at))
+    for chunk_row in chunk_rows:
+        await log_writer.log("document_chunks", chunk_row)
+    await log_writer.log("sb_qa_logs", (model_name, uuid_number, question_id, query, paraphrased_query, response,
+                                        source_text, error_message, created_at, chunk_ids, chunk_hashes, scores))
+
+
+async def _wait_for_answer(lookup):
+    # Repeats lookup() until it finds the answer row or ANSWER_LOOKUP_WAIT_SECONDS have passed
+    deadline = asyncio.get_running_loop().time() + ANSWER_LOOKUP_WAIT_SECONDS
+    while True:
+        result = await lookup()
+        if result or asyncio.get_running_loop().time() >= deadline:
+            return result
+        await asyncio.sleep(ANSWER_LOOKUP_POLL_SECONDS)
+
+
+async def get_source_chunks(engine, question_id):
+    return await _wait_for_answer(lambda: _fetch_source_chunks(engine, question_id))
+
+
+async def _fetch_source_chunks(engine, question_id):
     async with engine.acquire() as connection:
-        await connection.execute(
+        return await connection.fetch(
             '''
-            INSERT INTO qa_logs 
-            (model_name, uuid_number, query, paraphrased_query, response, source_text, error_message, created_at) 
-            VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
-            ''',
-            model_name, uuid_number, query, paraphrased_query, response, source_text, error_message,
-            datetime.now(pytz.UTC)
-        )
+            SELECT l.uuid_number, s.chunk_id, s.score, c.content
+            FROM sb_qa_logs l
+            LEFT JOIN LATERAL unnest(l.source_chunk_ids, l.source_chunk_hashes, l.source_scores)
+                WITH ORDINALITY AS s(chunk_id, content_hash, score, position) ON TRUE
+            LEFT JOIN document_chunks c ON c.uuid_number = l.uuid_number AND c.chunk_id = s.chunk_id
+                AND c.content_hash = s.content_hash
+            WHERE l.question_id = $1
+            ORDER BY s.position
+            ''', question_id)
 
 
-async def insert_document_store_logs(engine, description, uuid_number, documents_list, error_message):
+async def insert_indexing_job(engine, uuid_number, description, documents_list):
     async with engine.acquire() as connection:
         await connection.execute(
-            f'''
-            INSERT INTO document_store_logs
-            (description, uuid_number, documents_list, error_message, created_at)
-            VALUES ($1, $2, ARRAY {documents_list}, $3, $4)
-            ''', description, uuid_number, error_message, datetime.now(pytz.UTC))
+            '''
+            INSERT INTO indexing_jobs
+            (uuid_number, description, documents_list, status, stage, created_at, updated_at)
+            VALUES ($1, $2, $3, 'queued', 'queued', $4, $4)
+            ''', uuid_number, description, documents_list, datetime.now(pytz.UTC))
 
 
-async def insert_qa_voice_logs(engine, uuid_number, input_language, output_format, query, query_in_english,
-                               paraphrased_query, response, response_in_english, audio_output_link, source_text,
-                               error_message):
+async def update_indexing_job(engine, uuid_number, status, stage, error_message=None):
     async with engine.acquire() as connection:
         await connection.execute(
             '''
-            INSERT INTO qa_voice_logs 
-            (uuid_number, input_language, output_format, query, query_in_english, paraphrased_query, response, 
-            response_in_english, audio_output_link, source_text, error_message, created_at) 
-            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12)
-            ''',
-            uuid_number, input_language, output_format, query, query_in_english, paraphrased_query, response,
-            response_in_english, audio_output_link, source_text, error_message, datetime.now(pytz.UTC)
-        )
+            UPDATE indexing_jobs SET status = $2, stage = $3, error_message = $4, updated_at = $5
+            WHERE uuid_number = $1
+            ''', uuid_number, status, stage, error_message, datetime.now(pytz.UTC))
 
-async def insert_sb_qa_logs(engine, model_name, uuid_number, question_id, query, paraphrased_query, response, source_text,
-                         error_message):
+
+async def touch_indexing_jobs(engine, uuid_numbers):
     async with engine.acquire() as connection:
         await connection.execute(
             '''
-            INSERT INTO sb_qa_logs 
-            (model_name, uuid_number,question_id, query, paraphrased_query, response, source_text, error_message, created_at) 
-            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
-            ''',
-            model_name, uuid_number, question_id, query, paraphrased_query, response, source_text, error_message, datetime.now(pytz.UTC)
-        )
\ No newline at end of file
+            UPDATE indexing_jobs SET updated_at = $2
+            WHERE uuid_number = ANY($1::text[]) AND status IN ('queued', 'running')
+            ''', uuid_numbers, datetime.now(pytz.UTC))
+
+
+async def fail_stale_indexing_jobs(engine):
+    async with engine.acquire() as connection:
+        return await connection.fetch(
+            '''
+            UPDATE indexing_jobs SET status = 'failed', error_message = 'The worker running the job stopped',
+                updated_at = $1
+            WHERE status IN ('queued', 'running') AND updated_at < $2
+            RETURNING uuid_number
+            ''', datetime.now(pytz.UTC), datetime.now(pytz.UTC) - timedelta(seconds=INDEXING_JOB_STALE_SECONDS))
+
+
+async def run_indexing_job_heartbeat(engine, active_job_ids):
+    # Jobs live only in the worker that accepted them, so a job outlives its worker only as a row nobody touches
+    while True:
+        try:
+            await touch_indexing_jobs(engine, active_job_ids())
+            for record in await fail_stale_indexing_jobs(engine):
+                logger.warning(f"Indexing job {record['uuid_number']} lost its worker and was marked failed")
+        except Exception as e:
+            logger.exception(f"Indexing job heartbeat failed: {e}")
+        await asyncio.sleep(INDEXING_JOB_HEARTBEAT_SECONDS)
+
+
+async def get_indexing_job(engine, uuid_number):
+    async with engine.acquire() as connection:
+        return await connection.fetchrow(
+            '''
+            SELECT uuid_number, description, documents_list, status, stage, error_message, created_at, updated_at
+            FROM indexing_jobs WHERE uuid_number = $1
+            ''', uuid_number)
+
+
+# User feedback
+async def record_user_feedback(engine, qa_id, feedback_type):
+    feedback_column = {"up": "upvotes", "down": "downvotes"}.get(feedback_type.lower())
+    if feedback_column is None:
+        return None, f"Unknown feedback type {feedback_type}", 422
+    try:
+        record_id = await _wait_for_answer(lambda: _apply_user_feedback(engine, qa_id, feedback_column))
+        if record_id is None:
+            return None, f"Record with ID {qa_id} not found", 404
+        return 'OK', None, 200
+    except Exception as e:
+        error_message = str(e.__context__) + " and " + e.__str__()
+        status_code = 500
+        print(f"Error while giving feedback: {e}")
+        return None, error_message, status_code
+
+
+async def _apply_user_feedback(engine, qa_id, feedback_column):
+    async with engine.acquire() as connection:
+        # One indexed statement finds the answer, counts the vote and adds it to the rollup of the day
+        return await connection.fetchval(
+            f'''
+            WITH voted AS (
+                UPDATE sb_qa_logs SET {feedback_column} = {feedback_column} + 1 WHERE question_id = $1
+                RETURNING id, uuid_number
+            ), rolled_up AS (
+                INSERT INTO usage_rollups (uuid_number, day, {feedback_column})
+                SELECT uuid_number, (NOW() AT TIME ZONE 'UTC')::date, 1 FROM voted
+                ON CONFLICT (uuid_number, day) DO UPDATE
+                SET {feedback_column} = usage_rollups.{feedback_column} + EXCLUDED.{feedback_column}
+            )
+            SELECT id FROM voted
+            ''', qa_id)
+
+
+ROLLUP_METRICS = ["query_count", "error_count", "upvotes", "downvotes", "cache_hits"]
+
+
+async def get_usage_rollups(engine, start_date, end_date, uuid_number=None):
+    async with engine.acquire() as connection:
+        return await connection.fetch(
+            f'''
+            SELECT uuid_number, day, {", ".join(ROLLUP_METRICS)} FROM usage_rollups
+            WHERE day BETWEEN $1 AND $2 AND ($3::text IS NULL OR uuid_number = $3)
+            ORDER BY day, uuid_number
+            ''', start_date, end_date, uuid_number)
+
+
+async def get_usage_totals(engine, start_date, end_date, order_by="query_count", limit=100, uuid_number=None):
+    # order_by must be one of ROLLUP_METRICS
+    async with engine.acquire() as connection:
+        return await connection.fetch(
+            f'''
+            SELECT uuid_number, {", ".join(f"SUM({metric})::bigint AS {metric}" for metric in ROLLUP_METRICS)}
+            FROM usage_rollups WHERE day BETWEEN $1 AND $2 AND ($4::text IS NULL OR uuid_number = $4)
+            GROUP BY uuid_number ORDER BY {order_by} DESC LIMIT $3
+            ''', start_date, end_date, limit, uuid_number)
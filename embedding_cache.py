@@ -0,0 +1,79 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import numpy as np
+from langchain.embeddings.base import Embeddings
+from embedding_scheduler import embed_in_batches
+
+logger = logging.getLogger('jugalbandi_api')
+
+EMBEDDING_CACHE_PATH = os.environ.get("EMBEDDING_CACHE_PATH", "embedding_cache.sqlite3")
+# SQLite builds before 3.32 allow at most 999 bound parameters per statement
+_LOOKUP_BATCH_SIZE = 500
+
+
+def chunk_hash(model_name, text):
+    return hashlib.sha256((model_name + "\0" + text).encode("utf-8")).hexdigest()
+
+
+# Embeddings wrapper that only sends chunks it has never embedded with the same model to the API
+class CachedEmbeddings(Embeddings):
+    def __init__(self, embeddings, path=EMBEDDING_CACHE_PATH):
+        self.embeddings = embeddings
+        self.model_name = getattr(embeddings, "document_model_name", None) or getattr(embeddings, "model", "")
+        self.path = path
+
+    def embed_documents(self, texts):
+        keys = [chunk_hash(self.model_name, text) for text in texts]
+        connection = self._connect()
+        try:
+            cached = self._load(connection, set(keys))
+            missing = {}
+            for key, text in zip(keys, texts):
+                if key not in cached:
+                    missing[key] = text
+            logger.info(f"Embedding cache: {len(cached)} chunks reused, {len(missing)} chunks to embed")
+            if missing:
+                def store_batch(batch_texts, batch_vectors):
+                    new_vectors = {chunk_hash(self.model_name, text): vector
+                                   for text, vector in zip(batch_texts, batch_vectors)}
+                    self._store(connection, new_vectors)
+                    cached.update(new_vectors)
+
+                embed_in_batches(self.embeddings, list(missing.values()), on_batch_done=store_batch)
+        finally:
+            connection.close()
+        return [cached[key] for key in keys]
+
+    def embed_query(self, text):
+        return self.embeddings.embed_query(text)
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute('''
+            CREATE TABLE IF NOT EXISTS chunk_embeddings (
+                chunk_hash TEXT PRIMARY KEY,
+                embedding BLOB NOT NULL
+            )
+        ''')
+        return connection
+
+    def _load(self, connection, keys):
+        keys = list(keys)
+        cached = {}
+        for start in range(0, len(keys), _LOOKUP_BATCH_SIZE):
+            batch = keys[start:start + _LOOKUP_BATCH_SIZE]
+            rows = connection.execute(
+                f"SELECT chunk_hash, embedding FROM chunk_embeddings WHERE chunk_hash IN ({','.join('?' * len(batch))})",
+                batch)
+            for key, embedding in rows:
+                cached[key] = np.frombuffer(embedding, dtype=np.float32).tolist()
+        return cached
+
+    def _store(self, connection, vectors):
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO chunk_embeddings (chunk_hash, embedding) VALUES (?, ?)",
+                [(key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in vectors.items()])
@@ -0,0 +1,111 @@
+import fcntl
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import openai
+
+logger = logging.getLogger('jugalbandi_api')
+
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", 100))
+EMBEDDING_CONCURRENCY = int(os.environ.get("EMBEDDING_CONCURRENCY", 4))
+# Token budget of the whole node: every uvicorn worker and indexing process draws from the same bucket
+EMBEDDING_TOKENS_PER_MINUTE = int(os.environ.get("EMBEDDING_TOKENS_PER_MINUTE", 1000000))
+EMBEDDING_BUDGET_FILE = os.environ.get("EMBEDDING_BUDGET_FILE",
+                                       os.path.join(tempfile.gettempdir(), "jugalbandi_embedding_budget.json"))
+EMBEDDING_MAX_RETRIES = int(os.environ.get("EMBEDDING_MAX_RETRIES", 6))
+
+RETRYABLE_ERRORS = (openai.error.RateLimitError, openai.error.APIError, openai.error.ServiceUnavailableError,
+                    openai.error.Timeout, openai.error.APIConnectionError)
+
+
+# Token bucket refilled continuously at the per-minute budget. Its state lives in a small file locked with
+# flock, so concurrent uploads in all processes on the node share one budget instead of each getting the full rate.
+class TokenBudget:
+    def __init__(self, tokens_per_minute, state_path):
+        self.capacity = tokens_per_minute
+        self.state_path = state_path
+
+    def acquire(self, tokens):
+        tokens = min(tokens, self.capacity)
+        while True:
+            wait = self._take(tokens)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def _take(self, tokens):
+        # Returns 0 when the tokens were taken, otherwise how long to wait before trying again
+        with os.fdopen(os.open(self.state_path, os.O_RDWR | os.O_CREAT, 0o600), "r+") as state_file:
+            fcntl.flock(state_file, fcntl.LOCK_EX)
+            now = time.time()
+            try:
+                available, updated_at = json.loads(state_file.read())
+            except ValueError:
+                available, updated_at = self.capacity, now
+            available = min(self.capacity, available + max(0.0, now - updated_at) * self.capacity / 60)
+            wait = 0
+            if available >= tokens:
+                available -= tokens
+            else:
+                wait = (tokens - available) * 60 / self.capacity
+            state_file.seek(0)
+            state_file.truncate()
+            state_file.write(json.dumps([available, now]))
+        return wait
+
+
+token_budget = TokenBudget(EMBEDDING_TOKENS_PER_MINUTE, EMBEDDING_BUDGET_FILE)
+
+
+def estimate_tokens(text):
+    # Roughly four characters per token for English text
+    return len(text) // 4 + 1
+
+
+def _embed_batch(embeddings, texts, budget):
+    budget.acquire(sum(estimate_tokens(text) for text in texts))
+    for attempt in range(EMBEDDING_MAX_RETRIES + 1):
+        try:
+            return embeddings.embed_documents(texts)
+        except RETRYABLE_ERRORS as e:
+            if attempt == EMBEDDING_MAX_RETRIES:
+                raise
+            delay = min(60, 2 ** attempt) * random.uniform(0.5, 1.5)
+            logger.warning(f"Embedding batch failed ({e.__class__.__name__}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def embed_in_batches(embeddings, texts, on_batch_done=None):
+    # Embeds texts in concurrent batches under the token budget. Finished batches are handed to
+    # on_batch_done as they complete, so they are kept even if a later batch fails for good.
+    vectors = [None] * len(texts)
+    errors = []
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=EMBEDDING_CONCURRENCY, thread_name_prefix="embedding") as executor:
+        futures = {}
+        for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+            batch = texts[start:start + EMBEDDING_BATCH_SIZE]
+            futures[executor.submit(_embed_batch, embeddings, batch, token_budget)] = start
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+            start = futures[future]
+            try:
+                batch_vectors = future.result()
+            except Exception as e:
+                if not errors:
+                    for pending in futures:
+                        pending.cancel()
+                errors.append(e)
+                continue
+            vectors[start:start + len(batch_vectors)] = batch_vectors
+            if on_batch_done is not None:
+                on_batch_done(texts[start:start + len(batch_vectors)], batch_vectors)
+    if errors:
+        raise errors[0]
+    logger.info(f"Embedded {len(texts)} chunks in {len(futures)} batches in {time.time() - start_time:.1f}s")
+    return vectors
@@ -0,0 +1,106 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from langchain.embeddings.openai import OpenAIEmbeddings
+from langchain.vectorstores import FAISS
+from cloud_storage import get_index_version, read_langchain_index_files
+from mmap_index import is_mmap_index, load_mmap_index
+
+logger = logging.getLogger('jugalbandi_api')
+
+INDEX_CACHE_MAX_BYTES = int(os.environ.get("INDEX_CACHE_MAX_BYTES", 1024 * 1024 * 1024))
+# How long a worker trusts a loaded index before checking GCS for a newer published version
+INDEX_REVALIDATE_SECONDS = int(os.environ.get("INDEX_REVALIDATE_SECONDS", 60))
+
+
+IndexEntry = namedtuple("IndexEntry", ["search_index", "size", "version", "validated_at"])
+
+
+# Per-worker registry of loaded FAISS stores, evicted least-recently-used under a byte budget
+class IndexRegistry:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, uuid_number):
+        with self._lock:
+            entry = self._entries.get(uuid_number)
+            if entry is None:
+                return None
+            self._entries.move_to_end(uuid_number)
+            return entry
+
+    def put(self, uuid_number, search_index, size, version):
+        with self._lock:
+            self._remove(uuid_number)
+            if size > self.max_bytes:
+                logger.info(f"Index {uuid_number} ({size} bytes) exceeds the index cache budget, not cached")
+                return
+            self._entries[uuid_number] = IndexEntry(search_index, size, version, time.time())
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                evicted_uuid, evicted_entry = self._entries.popitem(last=False)
+                self.total_bytes -= evicted_entry.size
+                logger.info(f"Evicted index {evicted_uuid} from the index cache")
+
+    def mark_validated(self, uuid_number):
+        with self._lock:
+            entry = self._entries.get(uuid_number)
+            if entry is not None:
+                self._entries[uuid_number] = entry._replace(validated_at=time.time())
+
+    def invalidate(self, uuid_number):
+        with self._lock:
+            self._remove(uuid_number)
+
+    def _remove(self, uuid_number):
+        entry = self._entries.pop(uuid_number, None)
+        if entry is not None:
+            self.total_bytes -= entry.size
+
+
+index_registry = IndexRegistry(INDEX_CACHE_MAX_BYTES)
+
+
+def load_search_index(uuid_number):
+    entry = index_registry.get(uuid_number)
+    if entry is not None and time.time() - entry.validated_at < INDEX_REVALIDATE_SECONDS:
+        return entry.search_index
+    try:
+        if entry is not None:
+            # Another worker may have published a new version of this store since it was loaded
+            if get_index_version(uuid_number) == entry.version:
+                index_registry.mark_validated(uuid_number)
+                return entry.search_index
+        return _load_latest_search_index(uuid_number)
+    except Exception as e:
+        if entry is None:
+            raise
+        # A GCS error, or a version replaced again mid-download, should not fail queries the loaded store can answer
+        logger.warning(f"Refreshing index {uuid_number} failed, serving the loaded version: {e}")
+        index_registry.mark_validated(uuid_number)
+        return entry.search_index
+
+
+def _load_latest_search_index(uuid_number):
+    index_folder = read_langchain_index_files(uuid_number)
+    if index_folder is None:
+        index_registry.invalidate(uuid_number)
+        return None
+    if is_mmap_index(index_folder):
+        search_index = load_mmap_index(index_folder, OpenAIEmbeddings())
+    else:
+        # Stores published before the mmap layout still carry the pickled docstore
+        search_index = FAISS.load_local(index_folder, OpenAIEmbeddings())
+    # The on-disk size of the artifacts bounds the memory the store can take, mapped or not
+    size = sum(entry.stat().st_size for entry in os.scandir(index_folder) if entry.is_file())
+    index_registry.put(uuid_number, search_index, size, os.path.basename(index_folder))
+    return search_index
+
+
+def invalidate_search_index(uuid_number):
+    index_registry.invalidate(uuid_number)
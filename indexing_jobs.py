@@ -0,0 +1,73 @@
+import asyncio
+import functools
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+logger = logging.getLogger('jugalbandi_api')
+
+INDEXING_WORKERS = int(os.environ.get("INDEXING_WORKERS", 2))
+INDEXING_QUEUE_SIZE = int(os.environ.get("INDEXING_QUEUE_SIZE", 20))
+
+# Rough completion percentage reported once a job reaches each stage
+INDEXING_STAGES = {
+    "queued": 0,
+    "uploading_documents": 10,
+    "indexing": 30,
+    "uploading_index": 90,
+    "completed": 100,
+}
+
+_process_pool = None
+_job_slots = None
+# task -> uuid_number of the jobs queued or running in this worker
+_jobs = {}
+
+
+def get_process_pool():
+    global _process_pool
+    if _process_pool is None:
+        # spawn rather than fork: the parent is a threaded uvicorn worker
+        _process_pool = ProcessPoolExecutor(max_workers=INDEXING_WORKERS,
+                                            mp_context=multiprocessing.get_context("spawn"))
+    return _process_pool
+
+
+async def run_in_process_pool(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_process_pool(), functools.partial(func, *args))
+
+
+def submit_indexing_job(uuid_number, job):
+    # job is a coroutine function; returns False when the queue of this worker is full
+    if len(_jobs) >= INDEXING_QUEUE_SIZE:
+        return False
+    task = asyncio.create_task(_run_job(job))
+    _jobs[task] = uuid_number
+    task.add_done_callback(_forget_job)
+    return True
+
+
+def _forget_job(task):
+    _jobs.pop(task, None)
+
+
+def active_job_ids():
+    return list(_jobs.values())
+
+
+async def _run_job(job):
+    global _job_slots
+    if _job_slots is None:
+        _job_slots = asyncio.Semaphore(INDEXING_WORKERS)
+    async with _job_slots:
+        try:
+            await job()
+        except Exception as e:
+            logger.exception("Background indexing job failed: %s", e)
+
+
+def shutdown_indexing_jobs():
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
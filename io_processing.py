@@ -1,6 +1,5 @@
 import logging
 from translator import *
-import time
 
 log_format = '%(asctime)s - %(thread)d - %(threadName)s - %(name)s - %(levelname)s - %(message)s'
 logging.basicConfig(
@@ -55,13 +54,8 @@ def process_outgoing_voice(message, input_language):
     error_message = None
     decoded_audio_content = text_to_speech(language=input_language, text=message)
     if decoded_audio_content is not None:
-        logger.info("Creating output MP3 file")
-        time_stamp = time.strftime("%Y%m%d-%H%M%S")
-        filename = "audio-output-" + time_stamp + ".mp3"
-        output_mp3_file = open(filename, "wb")
-        output_mp3_file.write(decoded_audio_content)
-        logger.info("Audio Response is saved as a MP3 file.")
-        return output_mp3_file, error_message
+        # The MP3 bytes are returned as they are and uploaded from memory, never written to the working directory
+        return decoded_audio_content, error_message
     error_message = "Text to Audio conversion failed"
     logger.info(error_message)
     return None, error_message
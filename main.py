@@ -1,25 +1,36 @@
 import os.path
 from enum import Enum
-from typing import List
-from cachetools import TTLCache
+from datetime import date, datetime, timedelta
+from typing import List, Optional
 import secrets
-from fastapi import Depends, FastAPI, UploadFile, File, HTTPException, Form
+import pytz
+from fastapi import Depends, FastAPI, UploadFile, File, HTTPException, Form, Query
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from starlette.status import HTTP_401_UNAUTHORIZED
 from fastapi.middleware.cors import CORSMiddleware
+from google.api_core.exceptions import PreconditionFailed
 from pydantic import BaseModel
 from database_functions import *
 from io_processing import *
 from query_with_gptindex import *
 from query_with_langchain import *
 from cloud_storage import *
+from index_registry import invalidate_search_index
+from concurrency import run_blocking
+from response_cache import create_response_cache
+from semantic_cache import embed_query, semantic_cache
+from upload_workspace import UploadWorkspace
+from indexing_jobs import (INDEXING_STAGES, active_job_ids, run_in_process_pool, shutdown_indexing_jobs,
+                           submit_indexing_job)
+import asyncio
+import functools
 import uuid
 import shutil
-from zipfile import ZipFile
-from query_with_tfidf import querying_with_tfidf
+from query_with_tfidf import TFIDF_BATCH_MAX_QUERIES, querying_with_tfidf, querying_with_tfidf_batch
 from fastapi.responses import Response
 from sse_starlette.sse import EventSourceResponse
 import time
+from zipfile import BadZipFile
 
 api_description = """
 ## Generate context based questions from an extensive collection of documents/ information
@@ -40,11 +51,12 @@ app = FastAPI(title="Generate context based Questions (MCQ)",
               description=api_description,
               version="1.0.0"
               )
-ttl = int(os.environ.get("CACHE_TTL", 86400)) 
-cache = TTLCache(maxsize=100, ttl=ttl)
+cache = create_response_cache()
 
 security = HTTPBasic()
 db_engine = None
+log_writer = None
+partition_maintenance_task = None
 
 app.add_middleware(
     CORSMiddleware,
@@ -58,14 +70,22 @@ app.add_middleware(
 async def startup_event():
     logger.info('Invoking startup_event')
     load_dotenv()
-    global db_engine  # Declare db_engine as global
+    global db_engine, log_writer, partition_maintenance_task, indexing_job_heartbeat_task  # Declare them as global
     db_engine = await create_engine()
+    log_writer = LogWriter(db_engine)
+    log_writer.start()
+    partition_maintenance_task = asyncio.create_task(run_log_partition_maintenance(db_engine))
+    indexing_job_heartbeat_task = asyncio.create_task(run_indexing_job_heartbeat(db_engine, active_job_ids))
     logger.info('startup_event : Engine created')
 
 @app.on_event("shutdown")
 async def shutdown_event():
     logger.info('Invoking shutdown_event')
     load_dotenv()
+    shutdown_indexing_jobs()
+    partition_maintenance_task.cancel()
+    indexing_job_heartbeat_task.cancel()
+    await log_writer.stop()
     await db_engine.close()
     logger.info('shutdown_event : Engine closed')
 
@@ -83,6 +103,11 @@ class Response(BaseModel):
     source_text: str = None
 
 
+class SourceDocumentBatchRequest(BaseModel):
+    queries: List[str]
+    k: int = 3
+
+
 class ResponseForAudio(BaseModel):
     query: str = None
     query_in_english: str = None
@@ -97,6 +122,26 @@ class DropdownOutputFormat(str, Enum):
     VOICE = "Voice"
 
 
+class IndexType(str, Enum):
+    flat = "flat"
+    ivf = "ivf"
+    ivfpq = "ivfpq"
+    hnsw = "hnsw"
+
+
+class AnalyticsGrouping(str, Enum):
+    day = "day"
+    uuid = "uuid"
+
+
+class AnalyticsMetric(str, Enum):
+    query_count = "query_count"
+    error_count = "error_count"
+    upvotes = "upvotes"
+    downvotes = "downvotes"
+    cache_hits = "cache_hits"
+
+
 class DropDownInputLanguage(str, Enum):
     en = "English"
     hi = "Hindi"
@@ -140,11 +185,11 @@ async def query_using_gptindex(uuid_number: str, query_string: str, username: st
     # else:
         # print("Value not in cache", lowercase_query_string)
         load_dotenv()
-        answer, source_text, error_message, status_code = querying_with_gptindex(uuid_number, query_string)
-        engine = await create_engine()
-        await insert_qa_logs(engine=engine, model_name="gpt-index", uuid_number=uuid_number, query=query_string,
-                            paraphrased_query=None, response=answer, source_text=source_text, error_message=error_message)
-        await engine.close()
+        answer, source_text, error_message, status_code = await run_blocking("openai", querying_with_gptindex,
+                                                                              uuid_number, query_string)
+        await insert_qa_logs(log_writer, model_name="gpt-index", uuid_number=uuid_number, query=query_string,
+                             paraphrased_query=None, response=answer, source_text=source_text,
+                             error_message=error_message)
 
         if status_code != 200:
             print("Error status code", status_code)
@@ -161,16 +206,20 @@ async def query_using_gptindex(uuid_number: str, query_string: str, username: st
 
 @app.get("/query-with-langchain", tags=["Q&A over Document Store"], include_in_schema=False)
 async def query_using_langchain(uuid_number: str, query_string: str, username: str = Depends(get_current_username)) -> Response:
-    lowercase_query_string = query_string.lower() + uuid_number
-    if lowercase_query_string in cache:
-        print("Value in cache", lowercase_query_string)
-        return cache[lowercase_query_string]
+    cache_key = "langchain:" + query_string.lower()
+    cached_response = await run_blocking("cache", cache.get, uuid_number, cache_key)
+    if cached_response is not None:
+        print("Value in cache", cache_key)
+        log_writer.record_cache_hit(uuid_number)
+        return cached_response
     else:
-        print("Value not in cache", lowercase_query_string)
+        print("Value not in cache", cache_key)
         load_dotenv()
-        answer, source_text, paraphrased_query, error_message, status_code = querying_with_langchain(uuid_number,
-                                                                                                    query_string)
-        print(engine, "langchain", uuid_number, query_string, paraphrased_query, answer, source_text,)
+        answer, source_text, paraphrased_query, error_message, status_code = await run_blocking(
+            "openai", querying_with_langchain, uuid_number, query_string)
+        await insert_qa_logs(log_writer, model_name="langchain", uuid_number=uuid_number, query=query_string,
+                             paraphrased_query=paraphrased_query, response=answer, source_text=source_text,
+                             error_message=error_message)
         if status_code != 200:
             raise HTTPException(status_code=status_code, detail=error_message)
 
@@ -178,65 +227,194 @@ async def query_using_langchain(uuid_number: str, query_string: str, username: s
         response.query = query_string
         response.answer = answer
         response.source_text = source_text
-        cache[lowercase_query_string] = response
+        await run_blocking("cache", cache.set, uuid_number, cache_key, response.dict())
         return response
 
 
-@app.post("/upload-files", tags=["API for uploading documents - TXT / PDF "])
-async def upload_files(description: str, files: List[UploadFile] = File(...), username: str = Depends(get_current_username)):
-    load_dotenv()
-    uuid_number = str(uuid.uuid1())
-    os.makedirs(uuid_number)
+async def index_document_store(uuid_number, description, files_list, workspace, run_indexing, update_stage=None,
+                               index_type="flat"):
+    if update_stage is not None:
+        await update_stage("uploading_documents")
+    upload_summary = await run_blocking("gcs", bulk_upload_files, uuid_number,
+                                        [workspace.document_path(file_name) for file_name in files_list])
+    if upload_summary["failed_files"]:
+        return f"Uploading the documents failed for {', '.join(upload_summary['failed_files'])}", 503
+
+    if update_stage is not None:
+        await update_stage("indexing")
+    # error_message, status_code = gpt_indexing(uuid_number)
+    # if status_code == 200:
+    error_message, status_code = await run_indexing(langchain_indexing, workspace.documents_folder,
+                                                    workspace.index_folder, index_type)
+
+    await insert_document_store_logs(log_writer, description=description, uuid_number=uuid_number,
+                                     documents_list=files_list, error_message=error_message)
+
+    if status_code == 200:
+        if update_stage is not None:
+            await update_stage("uploading_index")
+        error_message, status_code = await publish_document_store_index(uuid_number, workspace)
+    return error_message, status_code
+
+
+async def publish_document_store_index(uuid_number, workspace, expected_version=None):
+    # Every artifact the indexer wrote is published, whatever the layout of the store
+    index_files = sorted(os.listdir(workspace.index_folder))
+    try:
+        upload_summary = await run_blocking("gcs", publish_index_version, uuid_number,
+                                            [workspace.index_path(index_file) for index_file in index_files],
+                                            expected_version)
+    except PreconditionFailed:
+        return "The document store was updated by another request. Please try again", 409
+    if upload_summary["failed_files"]:
+        return f"Uploading the index failed for {', '.join(upload_summary['failed_files'])}", 503
+    invalidate_search_index(uuid_number)
+    await run_blocking("cache", cache.invalidate, uuid_number)
+    semantic_cache.invalidate(uuid_number)
+    return None, 200
+
+
+async def append_to_document_store(uuid_number, description, files_list, workspace):
+    existing_index_folder = await run_blocking("gcs", read_langchain_index_files, uuid_number)
+    if existing_index_folder is None:
+        return "The UUID number is incorrect", 422
+    error_message, status_code = await run_blocking("indexing", langchain_append_indexing,
+                                                    workspace.documents_folder, existing_index_folder,
+                                                    workspace.index_folder)
+    await insert_document_store_logs(log_writer, description=description, uuid_number=uuid_number,
+                                     documents_list=files_list, error_message=error_message)
+    if status_code != 200:
+        return error_message, status_code
+
+    # Documents are uploaded only once indexing succeeded, and new ones are removed again if the index is not
+    # published, so read_files never picks up documents the published index does not contain
+    existing_documents = set(await run_blocking("gcs", list_document_files, uuid_number))
+    new_documents = [file_name for file_name in files_list if file_name not in existing_documents]
+    upload_summary = await run_blocking("gcs", bulk_upload_files, uuid_number,
+                                        [workspace.document_path(file_name) for file_name in files_list])
+    if upload_summary["failed_files"]:
+        error_message = f"Uploading the documents failed for {', '.join(upload_summary['failed_files'])}"
+        status_code = 503
+    else:
+        # The cache folder is named after the version it holds, which is the version being extended
+        error_message, status_code = await publish_document_store_index(uuid_number, workspace,
+                                                                        os.path.basename(existing_index_folder))
+    if status_code != 200:
+        await run_blocking("gcs", delete_files, uuid_number, new_documents)
+    return error_message, status_code
+
+
+async def run_indexing_job(uuid_number, description, files_list, workspace, index_type="flat"):
+    current_stage = "queued"
+
+    async def update_stage(stage):
+        nonlocal current_stage
+        current_stage = stage
+        await update_indexing_job(db_engine, uuid_number, "running", stage)
+
+    try:
+        error_message, status_code = await index_document_store(uuid_number, description, files_list, workspace,
+                                                                run_in_process_pool, update_stage, index_type)
+    except Exception as e:
+        error_message = str(e.__context__) + " and " + e.__str__()
+        status_code = 500
+    finally:
+        workspace.cleanup()
+    if status_code == 200:
+        await update_indexing_job(db_engine, uuid_number, "completed", "completed")
+    else:
+        await update_indexing_job(db_engine, uuid_number, "failed", current_stage, error_message)
+
+
+async def save_uploaded_files(workspace, files):
     files_list = []
     for file in files:
         try:
-            contents = file.file.read()
-            with open(file.filename, 'wb') as f:
-                f.write(contents)
+            upload_path = await workspace.save_upload(file)
         except OSError:
-            return "There was an error uploading the file(s)"
+            return None
         finally:
-            if ".zip" in file.filename:
-                os.makedirs("temp_archive")
-                with ZipFile(file.filename, 'r') as zip_ref:
-                    zip_ref.extractall("temp_archive")
-                bad_zip_folder = "temp_archive/__MACOSX"
-                if os.path.exists(bad_zip_folder):
-                    shutil.rmtree(bad_zip_folder)
-                archived_files = os.listdir("temp_archive")
-                files_list.extend(archived_files)
-                for archived_file in archived_files:
-                    shutil.move("temp_archive/" + archived_file, archived_file)
-                    upload_file(uuid_number, archived_file)
-                    shutil.move(archived_file, uuid_number + "/" + archived_file)
-                shutil.rmtree("temp_archive")
-                os.remove(file.filename)
-            else:
-                files_list.append(file.filename)
-                upload_file(uuid_number, file.filename)
-                file.file.close()
-                shutil.move(file.filename, uuid_number + "/" + file.filename)
+            await file.close()
+        if file.filename.lower().endswith(".zip"):
+            try:
+                files_list.extend(await run_blocking("indexing", workspace.extract_archive, upload_path))
+            except BadZipFile:
+                raise HTTPException(status_code=400, detail=f"{file.filename} is not a valid zip archive")
+        else:
+            files_list.extend(workspace.add_document(upload_path))
+    return files_list
 
-    # error_message, status_code = gpt_indexing(uuid_number)
-    # if status_code == 200:
-    error_message, status_code = langchain_indexing(uuid_number)
 
-    # engine = await create_engine()
-    await insert_document_store_logs(engine=db_engine, description=description, uuid_number=uuid_number,
-                                     documents_list=files_list, error_message=error_message)
-    # await engine.close()
+@app.post("/upload-files", tags=["API for uploading documents - TXT / PDF "])
+async def upload_files(description: str, files: List[UploadFile] = File(...), async_mode: bool = False,
+                       index_type: IndexType = IndexType.flat, username: str = Depends(get_current_username)):
+    load_dotenv()
+    uuid_number = str(uuid.uuid1())
+    workspace = UploadWorkspace()
+    # A queued job removes the workspace when it finishes; on every other path it is removed here
+    queued = False
+    try:
+        files_list = await save_uploaded_files(workspace, files)
+        if files_list is None:
+            return "There was an error uploading the file(s)"
 
+        if async_mode:
+            await insert_indexing_job(db_engine, uuid_number, description, files_list)
+            if not submit_indexing_job(uuid_number, functools.partial(run_indexing_job, uuid_number, description,
+                                                                      files_list, workspace, index_type.value)):
+                await update_indexing_job(db_engine, uuid_number, "failed", "queued", "Indexing queue is full")
+                raise HTTPException(status_code=503, detail="Indexing queue is full. Please try again later")
+            queued = True
+            return {"uuid_number": str(uuid_number), "message": "Files are queued for indexing",
+                    "status_url": "/upload-status/" + str(uuid_number)}
+
+        error_message, status_code = await index_document_store(uuid_number, description, files_list, workspace,
+                                                                functools.partial(run_blocking, "indexing"),
+                                                                index_type=index_type.value)
+    finally:
+        if not queued:
+            workspace.cleanup()
     if status_code != 200:
         raise HTTPException(status_code=status_code, detail=error_message)
-
-    index_files = ["index.faiss", "index.pkl"]  # original:  ["index.json", "index.faiss", "index.pkl"]
-    for index_file in index_files:
-        upload_file(uuid_number, index_file)
-        os.remove(index_file)
-    shutil.rmtree(uuid_number)
     return {"uuid_number": str(uuid_number), "message": "Files uploading is successful"}
 
 
+@app.post("/append-files", tags=["API for uploading documents - TXT / PDF "])
+async def append_files(uuid_number: str, description: str = "", files: List[UploadFile] = File(...),
+                       username: str = Depends(get_current_username)):
+    load_dotenv()
+    uuid_number = uuid_number.strip()
+    workspace = UploadWorkspace()
+    try:
+        files_list = await save_uploaded_files(workspace, files)
+        if files_list is None:
+            return "There was an error uploading the file(s)"
+        error_message, status_code = await append_to_document_store(uuid_number, description, files_list,
+                                                                    workspace)
+    finally:
+        workspace.cleanup()
+    if status_code != 200:
+        raise HTTPException(status_code=status_code, detail=error_message)
+    return {"uuid_number": uuid_number, "message": "Files appending is successful"}
+
+
+@app.get("/upload-status/{uuid_number}", tags=["API for uploading documents - TXT / PDF "])
+async def get_upload_status(uuid_number: str, username: str = Depends(get_current_username)):
+    job = await get_indexing_job(db_engine, uuid_number)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"No indexing job found for {uuid_number}")
+    return {
+        "uuid_number": job["uuid_number"],
+        "status": job["status"],
+        "stage": job["stage"],
+        "progress": INDEXING_STAGES.get(job["stage"], 0),
+        "documents_list": job["documents_list"],
+        "error_message": job["error_message"],
+        "created_at": job["created_at"],
+        "updated_at": job["updated_at"],
+    }
+
+
 @app.get("/query-using-voice", tags=["Q&A over Document Store"], include_in_schema=False)
 async def query_with_voice_input(uuid_number: str, input_language: DropDownInputLanguage,
                                  output_format: DropdownOutputFormat, query_text: str = "",
@@ -258,28 +436,28 @@ async def query_with_voice_input(uuid_number: str, input_language: DropDownInput
         status_code = 422
     else:
         if query_text != "":
-            text, error_message = process_incoming_text(query_text, language)
+            text, error_message = await run_blocking("translation", process_incoming_text, query_text, language)
             if output_format.name == "VOICE":
                 is_audio = True
         else:
-            query_text, text, error_message = process_incoming_voice(audio_url, language)
+            query_text, text, error_message = await run_blocking("translation", process_incoming_voice, audio_url,
+                                                                 language)
             output_medium = "VOICE"
             is_audio = True
 
         if text is not None:
             print(text)
-            answer, source_text, paraphrased_query, error_message, status_code = querying_with_langchain_gpt4(uuid_number,
-                                                                                                         text)
+            answer, source_text, paraphrased_query, error_message, status_code = await run_blocking(
+                "openai", querying_with_langchain_gpt4, uuid_number, text)
             if answer is not None:
-                regional_answer, error_message = process_outgoing_text(answer, language)
+                regional_answer, error_message = await run_blocking("translation", process_outgoing_text, answer,
+                                                                    language)
                 if regional_answer is not None:
                     if is_audio:
-                        output_file, error_message = process_outgoing_voice(regional_answer, language)
-                        if output_file is not None:
-                            upload_file("output_audio_files", output_file.name)
-                            audio_output_url = give_public_url(output_file.name)
-                            output_file.close()
-                            os.remove(output_file.name)
+                        audio_content, error_message = await run_blocking("translation", process_outgoing_voice,
+                                                                          regional_answer, language)
+                        if audio_content is not None:
+                            audio_output_url = await run_blocking("gcs", upload_output_audio, audio_content)
                         else:
                             status_code = 503
                     else:
@@ -289,13 +467,11 @@ async def query_with_voice_input(uuid_number: str, input_language: DropDownInput
         else:
             status_code = 503
 
-    engine = await create_engine()
-    await insert_qa_voice_logs(engine=engine, uuid_number=uuid_number, input_language=input_language.value,
+    await insert_qa_voice_logs(log_writer, uuid_number=uuid_number, input_language=input_language.value,
                                output_format=output_medium, query=query_text, query_in_english=text,
                                paraphrased_query=paraphrased_query, response=regional_answer,
                                response_in_english=answer,
                                audio_output_link=audio_output_url, source_text=source_text, error_message=error_message)
-    await engine.close()
     if status_code != 200:
         raise HTTPException(status_code=status_code, detail=error_message)
 
@@ -312,7 +488,7 @@ async def query_with_voice_input(uuid_number: str, input_language: DropDownInput
 @app.get("/rephrased-query", include_in_schema=False)
 async def get_rephrased_query(query_string: str, username: str = Depends(get_current_username)):
     load_dotenv()
-    answer = rephrased_question(query_string)
+    answer = await run_blocking("openai", rephrased_question, query_string)
     return {"given_query": query_string, "rephrased_query": answer}
 
 
@@ -320,29 +496,40 @@ async def get_rephrased_query(query_string: str, username: str = Depends(get_cur
 async def get_source_document(query_string: str = "", input_language: DropDownInputLanguage = DropDownInputLanguage.en,
                               audio_file: UploadFile = File(None), username: str = Depends(get_current_username)):
     load_dotenv()
-    filename = ""
-    if audio_file is not None:
-        try:
-            contents = audio_file.file.read()
-            with open(audio_file.filename, 'wb') as f:
-                f.write(contents)
-            filename = audio_file.filename
-        except OSError:
-            return "There was an parsing the audio file"
-    answer = querying_with_tfidf(query_string, input_language.name, filename)  
+    # The upload is decoded from memory, so concurrent requests never share a file on disk
+    audio_content = await audio_file.read() if audio_file is not None else b""
+    if query_string == "":
+        # Speech to text waits on the translation APIs; only the title search below is CPU-bound
+        _, query_string, error_message = await run_blocking("translation", process_incoming_voice, audio_content,
+                                                            input_language.name)
+        if query_string is None:
+            raise HTTPException(status_code=503, detail=error_message)
+    answer = await run_blocking("tfidf", querying_with_tfidf, query_string, input_language.name, audio_content)
     return answer
 
 
+@app.post("/source-document-batch", tags=["Source Document over Document Store"], include_in_schema=False)
+async def get_source_documents_batch(request: SourceDocumentBatchRequest,
+                                     username: str = Depends(get_current_username)):
+    if len(request.queries) > TFIDF_BATCH_MAX_QUERIES:
+        raise HTTPException(status_code=422, detail=f"At most {TFIDF_BATCH_MAX_QUERIES} queries are allowed per batch")
+    if not request.queries:
+        return []
+    return await run_blocking("tfidf", querying_with_tfidf_batch, request.queries, max(1, request.k))
+
+
 @app.get("/query-with-langchain-gpt4", tags=["Q&A over Document Store"], include_in_schema=False)
 async def query_using_langchain_with_gpt4(uuid_number: str, query_string: str, username: str = Depends(get_current_username)) -> Response:
-    lowercase_query_string = query_string.lower() + uuid_number
-    if lowercase_query_string in cache:
-        print("Value in cache", lowercase_query_string)
-        return cache[lowercase_query_string]
+    cache_key = "langchain-gpt4:" + query_string.lower()
+    cached_response = await run_blocking("cache", cache.get, uuid_number, cache_key)
+    if cached_response is not None:
+        print("Value in cache", cache_key)
+        log_writer.record_cache_hit(uuid_number)
+        return cached_response
     else:
         load_dotenv()
-        answer, source_text, paraphrased_query, error_message, status_code = querying_with_langchain_gpt4(uuid_number,
-                                                                                                        query_string)
+        answer, source_text, paraphrased_query, error_message, status_code = await run_blocking(
+            "openai", querying_with_langchain_gpt4, uuid_number, query_string)
 
         if status_code != 200:
             raise HTTPException(status_code=status_code, detail=error_message)
@@ -351,60 +538,34 @@ async def query_using_langchain_with_gpt4(uuid_number: str, query_string: str, u
         response.query = query_string
         response.answer = answer
         response.source_text = source_text
-        cache[lowercase_query_string] = response
+        await run_blocking("cache", cache.set, uuid_number, cache_key, response.dict())
         return response
 
 @app.get("/query-with-langchain-gpt4_streaming", tags=["Q&A over Document Store"], include_in_schema=False)
 async def query_using_langchain_with_gpt4_streaming(uuid_number: str, query_string: str, username: str = Depends(get_current_username)) -> EventSourceResponse:
-    lowercase_query_string = "streaming_" + query_string.lower() + uuid_number
-    if lowercase_query_string in cache:
-        print("Value in cache", lowercase_query_string)
-        return cache[lowercase_query_string]
-    else:
-        load_dotenv()
-        response = querying_with_langchain_gpt4_streaming(uuid_number, query_string)
-
-        if isinstance(response, EventSourceResponse):
-            # If the response is already a StreamingResponse, return it directly
-            return response
-
-        # print(response)
-
-        if response.status_code != 200:
-            # If there's an error, raise an HTTPException
-            raise HTTPException(status_code=response.status_code, detail=response.text)
-
-        # Retrieve the response content
-        # response_content = await response.content.read()
-
-        # Create a StreamingResponse with the response content
-        streaming_response = EventSourceResponse(
-            response.content,
-            headers={"Content-Type":"text/plain"}
-        )
-
-        # Set the response headers
-        for header, value in response.headers.items():
-            streaming_response.headers[header] = value
-
-        # Store the streaming_response object in the cache
-        cache[lowercase_query_string] = streaming_response
+    load_dotenv()
+    response = await run_blocking("openai", querying_with_langchain_gpt4_streaming, uuid_number, query_string)
+    if isinstance(response, EventSourceResponse):
+        return response
+    raise HTTPException(status_code=response.status_code, detail=response.body.decode())
 
-        return streaming_response
-    
 @app.get("/generate-mcq-questions", tags=["API for generating Multiple Choice Questions"], response_class = CSVResponse)
 async def query_using_langchain_with_gpt4_mcq(uuid_number: str, query_string: str, skip_cache : bool = False, username: str = Depends(get_current_username)) -> CSVResponse:
     load_dotenv()
     start_time = time.time()
     caching = False # disabled caching
     uuid_number = uuid_number.strip()
-    lowercase_query_string = query_string.lower() + uuid_number
-    if (lowercase_query_string in cache) and (not skip_cache):
-        print("Value in cache", lowercase_query_string)
-        return CSVResponse(content=cache[lowercase_query_string])
+    cache_key = "mcq:" + query_string.lower()
+    cached_response = None if skip_cache else await run_blocking("cache", cache.get, uuid_number, cache_key)
+    if cached_response is not None:
+        print("Value in cache", cache_key)
+        log_writer.record_cache_hit(uuid_number)
+        return CSVResponse(content=cached_response)
     else:
         load_dotenv()
-        answer, source_text, paraphrased_query, error_message, status_code = querying_with_langchain_gpt4_mcq(
+        answer, source_text, paraphrased_query, error_message, status_code = await run_blocking(
+            "openai",
+            querying_with_langchain_gpt4_mcq,
             uuid_number,
             query_string,
             caching
@@ -414,24 +575,47 @@ async def query_using_langchain_with_gpt4_mcq(uuid_number: str, query_string: st
         if status_code != 200:
             raise HTTPException(status_code=status_code, detail=error_message)
         
-        cache[lowercase_query_string] = answer
+        await run_blocking("cache", cache.set, uuid_number, cache_key, answer)
         return CSVResponse(answer)
 
+async def serve_cached_answer(uuid_number, query_string, cached_response):
+    # A cached answer gets a new question id and its own log row, so feedback on it
+    # counts against this question and not the earlier one that produced the answer
+    question_id = str(uuid.uuid1())
+    await insert_sb_qa_logs(log_writer, model_name=CACHED_ANSWER_MODEL, uuid_number=uuid_number,
+                            question_id=question_id, query=query_string, paraphrased_query=None,
+                            response=cached_response["answer"], source_text=None, error_message=None)
+    return {**cached_response, "id": question_id, "query": query_string}
+
+
 @app.get("/generate_answers", tags=["API for generating answers"])
 async def query_using_langchain_with_gpt3(uuid_number: str, query_string: str, skip_cache : bool = False):
     uuid_number = uuid_number.strip()
-    lowercase_query_string = query_string.lower() + uuid_number
-    if (lowercase_query_string in cache) and (not skip_cache):
-        print("Value in cache", lowercase_query_string)
-        return cache[lowercase_query_string]
+    cache_key = "answers:" + query_string.lower()
+    cached_response = None if skip_cache else await run_blocking("cache", cache.get, uuid_number, cache_key)
+    if cached_response is not None:
+        print("Value in cache", cache_key)
+        return await serve_cached_answer(uuid_number, query_string, cached_response)
     else:
         load_dotenv()
+        # The query embedding drives both the semantic cache lookup and the FAISS search
+        try:
+            query_embedding = await run_blocking("openai", embed_query, query_string)
+        except Exception as e:
+            logger.warning(f"Query embedding failed, skipping the semantic cache: {e}")
+            query_embedding = None
+        if query_embedding is not None and not skip_cache:
+            cached_response = semantic_cache.lookup(uuid_number, query_embedding)
+            if cached_response is not None:
+                return await serve_cached_answer(uuid_number, query_string, cached_response)
         question_id = str(uuid.uuid1())
-        answer, source_text, paraphrased_query, error_message, status_code = querying_with_langchain_gpt3(uuid_number, query_string)
-        # engine = await create_engine()
-        await insert_sb_qa_logs(engine=db_engine, model_name="gpt-3.5-turbo-16k", uuid_number=uuid_number, question_id=question_id,
-                                               query=query_string, paraphrased_query=None, response=answer, source_text=source_text, error_message=error_message)
-        # await engine.close()
+        answer, source_documents, paraphrased_query, error_message, status_code = await run_blocking(
+            "openai", querying_with_langchain_gpt3, uuid_number, query_string, query_embedding)
+        source_chunks = [(str(document.metadata.get("source", "")), document.page_content, float(score))
+                         for document, score in source_documents or []]
+        await insert_sb_qa_logs(log_writer, model_name="gpt-3.5-turbo-16k", uuid_number=uuid_number, question_id=question_id,
+                                               query=query_string, paraphrased_query=None, response=answer, source_text=None, error_message=error_message,
+                                               source_chunks=source_chunks)
         logger.info(f"Question ID =====> {question_id}")
         if status_code != 200:
             raise HTTPException(status_code=status_code, detail=error_message)
@@ -442,7 +626,9 @@ async def query_using_langchain_with_gpt3(uuid_number: str, query_string: str, s
             "answer": answer,
             "source_text" : ''
         }
-        cache[lowercase_query_string] = response
+        await run_blocking("cache", cache.set, uuid_number, cache_key, response)
+        if query_embedding is not None:
+            semantic_cache.add(uuid_number, query_embedding, response)
         return response
     
 @app.put("/user_feedback", tags=["API for recording user feedback for Q&A"])
@@ -454,4 +640,46 @@ async def feedback_endpoint(question_id: str = Form(...), feedback_type: Feedbac
     if status_code != 200:
         raise HTTPException(status_code=status_code, detail=error_message)
 
-    return {"message": f"Feedback recorded for question ID {question_id} with feedback type {feedback_type}"}
\ No newline at end of file
+    return {"message": f"Feedback recorded for question ID {question_id} with feedback type {feedback_type}"}
+
+
+@app.get("/source-chunks/{question_id}", tags=["API for generating answers"])
+async def get_answer_source_chunks(question_id: str, username: str = Depends(get_current_username)):
+    rows = await get_source_chunks(db_engine, question_id)
+    if not rows:
+        raise HTTPException(status_code=404, detail=f"Record with ID {question_id} not found")
+    return {
+        "id": question_id,
+        "uuid_number": rows[0]["uuid_number"],
+        "source_chunks": [{"chunk_id": row["chunk_id"], "score": row["score"], "source_text": row["content"]}
+                          for row in rows if row["chunk_id"] is not None],
+    }
+
+
+@app.get("/analytics", tags=["API for usage analytics"])
+async def get_analytics(start_date: Optional[date] = None, end_date: Optional[date] = None,
+                        uuid_number: Optional[str] = None, group_by: AnalyticsGrouping = AnalyticsGrouping.day,
+                        order_by: AnalyticsMetric = AnalyticsMetric.query_count, limit: int = Query(100, ge=1, le=1000),
+                        username: str = Depends(get_current_username)):
+    # Served only from usage_rollups; the raw log tables are never scanned here.
+    # query_count counts answers generated by a model, cache_hits the answers served from a cache.
+    end_date = end_date or datetime.now(pytz.UTC).date()
+    start_date = start_date or end_date - timedelta(days=6)
+    if group_by == AnalyticsGrouping.uuid:
+        rows = await get_usage_totals(db_engine, start_date, end_date, order_by.value, limit, uuid_number)
+    else:
+        rows = await get_usage_rollups(db_engine, start_date, end_date, uuid_number)
+    return {"start_date": start_date, "end_date": end_date, "group_by": group_by.value,
+            "rows": [dict(row) for row in rows]}
+
+
+@app.get("/cache-stats", include_in_schema=False)
+async def get_cache_stats(username: str = Depends(get_current_username)):
+    stats = await run_blocking("cache", cache.stats)
+    stats["translation_cache"] = translation_cache.stats()
+    return stats
+
+
+@app.get("/log-stats", include_in_schema=False)
+async def get_log_stats(username: str = Depends(get_current_username)):
+    return log_writer.stats()
@@ -0,0 +1,174 @@
+import json
+import mmap
+import os
+import shutil
+import faiss
+import numpy as np
+from langchain.docstore.base import Docstore
+from langchain.docstore.document import Document
+from langchain.vectorstores import FAISS
+from ann_index import (ANN_INDEX_FILE, build_ann_index, choose_index_type, evaluate_index, exact_search,
+                       rerank_search, search_parameter_override, set_search_parameter)
+
+# Compact store layout: vectors and their squared norms as .npy files, chunk records as
+# concatenated JSON in docstore.bin addressed by docstore.offsets.npy. Everything is opened
+# with mmap, so loading is close to free and the pages are shared by all workers on a node.
+# Approximate stores add ann.faiss; vectors.npy is kept to re-rank candidates, retrain on append and measure recall.
+INDEX_META_FILE = "index_meta.json"
+VECTORS_FILE = "vectors.npy"
+NORMS_FILE = "norms.npy"
+DOCSTORE_FILE = "docstore.bin"
+OFFSETS_FILE = "docstore.offsets.npy"
+INDEX_FORMAT = "mmap-v1"
+
+
+def is_mmap_index(index_folder):
+    return os.path.isfile(os.path.join(index_folder, INDEX_META_FILE))
+
+
+# Exact L2 search over memory-mapped vectors, returning squared distances like faiss.IndexFlatL2
+class MmapFlatIndex:
+    def __init__(self, vectors, norms):
+        self.vectors = vectors
+        self.norms = norms
+        self.ntotal, self.d = vectors.shape
+
+    def search(self, queries, k):
+        return exact_search(queries, self.vectors, self.norms, k)
+
+
+# Approximate index whose candidates are re-ranked by exact distance against the memory-mapped vectors
+class RerankedAnnIndex:
+    def __init__(self, index, vectors, norms):
+        self.index = index
+        self.vectors = vectors
+        self.norms = norms
+        self.ntotal, self.d = vectors.shape
+
+    def search(self, queries, k):
+        return rerank_search(self.index, queries, k, self.vectors, self.norms)
+
+
+# Docstore that materializes a chunk only when a search hit asks for it
+class MmapDocstore(Docstore):
+    def __init__(self, index_folder):
+        self.offsets = np.load(os.path.join(index_folder, OFFSETS_FILE), mmap_mode="r")
+        with open(os.path.join(index_folder, DOCSTORE_FILE), "rb") as f:
+            # mmap cannot map an empty file, which is what a store without chunks has
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+
+    def search(self, search):
+        position = int(search)
+        if position < 0 or position >= len(self.offsets) - 1:
+            return f"ID {search} not found."
+        record = json.loads(self._data[int(self.offsets[position]):int(self.offsets[position + 1])])
+        return Document(page_content=record["page_content"], metadata=record["metadata"])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+# Chunk i of the store has docstore id str(i), so no id dictionary has to be kept in memory
+class PositionalIds:
+    def __init__(self, size):
+        self.size = size
+
+    def __getitem__(self, position):
+        if position < 0 or position >= self.size:
+            raise KeyError(position)
+        return str(int(position))
+
+    def __len__(self):
+        return self.size
+
+
+def read_index_meta(index_folder):
+    with open(os.path.join(index_folder, INDEX_META_FILE)) as f:
+        return json.load(f)
+
+
+def load_mmap_index(index_folder, embeddings):
+    meta = read_index_meta(index_folder)
+    index_type = meta.get("index_type", "flat")
+    vectors = np.load(os.path.join(index_folder, VECTORS_FILE), mmap_mode="r")
+    norms = np.load(os.path.join(index_folder, NORMS_FILE), mmap_mode="r")
+    if index_type == "flat":
+        index = MmapFlatIndex(vectors, norms)
+    else:
+        # With IO_FLAG_MMAP faiss reads the IVF inverted lists as OnDiskInvertedLists mapped from ann.faiss
+        # (checked with faiss-cpu 1.7.3); HNSW graphs are always read into memory
+        io_flags = faiss.IO_FLAG_MMAP if index_type in ("ivf", "ivfpq") else 0
+        ann_index = faiss.read_index(os.path.join(index_folder, ANN_INDEX_FILE), io_flags)
+        set_search_parameter(ann_index, index_type,
+                             search_parameter_override(index_type) or meta["search_parameter_value"])
+        index = RerankedAnnIndex(ann_index, vectors, norms)
+    docstore = MmapDocstore(index_folder)
+    return FAISS(embeddings.embed_query, index, docstore, PositionalIds(meta["ntotal"]))
+
+
+def _write_records(f, documents, offsets):
+    for document in documents:
+        record = json.dumps({"page_content": document.page_content, "metadata": document.metadata}).encode("utf-8")
+        f.write(record)
+        offsets.append(offsets[-1] + len(record))
+
+
+def _finish_index(index_folder, requested_index_type):
+    # Builds the approximate index if one was requested and writes the metadata, which also marks the store complete
+    vectors = np.load(os.path.join(index_folder, VECTORS_FILE), mmap_mode="r")
+    norms = np.load(os.path.join(index_folder, NORMS_FILE), mmap_mode="r")
+    ntotal, dimension = vectors.shape
+    index_type = choose_index_type(requested_index_type, ntotal, dimension)
+    index = None
+    if index_type != "flat":
+        index = build_ann_index(np.array(vectors, dtype=np.float32), index_type)
+    meta = {"format": INDEX_FORMAT, "index_type": index_type, "requested_index_type": requested_index_type,
+            "ntotal": ntotal, "dimension": dimension}
+    meta.update(evaluate_index(index, index_type, vectors, norms))
+    if index is not None:
+        faiss.write_index(index, os.path.join(index_folder, ANN_INDEX_FILE))
+    with open(os.path.join(index_folder, INDEX_META_FILE), "w") as f:
+        json.dump(meta, f)
+
+
+def write_mmap_index(index_folder, documents, vectors, index_type="flat"):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    np.save(os.path.join(index_folder, VECTORS_FILE), vectors)
+    np.save(os.path.join(index_folder, NORMS_FILE), (vectors ** 2).sum(axis=1))
+    offsets = [0]
+    with open(os.path.join(index_folder, DOCSTORE_FILE), "wb") as f:
+        _write_records(f, documents, offsets)
+    np.save(os.path.join(index_folder, OFFSETS_FILE), np.array(offsets, dtype=np.int64))
+    _finish_index(index_folder, index_type)
+
+
+def append_mmap_index(existing_folder, index_folder, documents, vectors):
+    # Writes existing store + new chunks to index_folder without loading the existing store into memory.
+    # Approximate indexes are retrained on the merged vectors, with the index type the store was created with.
+    vectors = np.asarray(vectors, dtype=np.float32)
+    old_vectors = np.load(os.path.join(existing_folder, VECTORS_FILE), mmap_mode="r")
+    ntotal = len(old_vectors) + len(vectors)
+    merged = np.lib.format.open_memmap(os.path.join(index_folder, VECTORS_FILE), mode="w+", dtype=np.float32,
+                                       shape=(ntotal, old_vectors.shape[1]))
+    merged[:len(old_vectors)] = old_vectors
+    merged[len(old_vectors):] = vectors
+    merged.flush()
+    del merged
+    old_norms = np.load(os.path.join(existing_folder, NORMS_FILE), mmap_mode="r")
+    np.save(os.path.join(index_folder, NORMS_FILE), np.concatenate([old_norms, (vectors ** 2).sum(axis=1)]))
+    shutil.copyfile(os.path.join(existing_folder, DOCSTORE_FILE), os.path.join(index_folder, DOCSTORE_FILE))
+    offsets = list(np.load(os.path.join(existing_folder, OFFSETS_FILE)))
+    with open(os.path.join(index_folder, DOCSTORE_FILE), "ab") as f:
+        _write_records(f, documents, offsets)
+    np.save(os.path.join(index_folder, OFFSETS_FILE), np.array(offsets, dtype=np.int64))
+    existing_meta = read_index_meta(existing_folder)
+    _finish_index(index_folder, existing_meta.get("requested_index_type", existing_meta.get("index_type", "flat")))
+
+
+def convert_legacy_index(legacy_folder, index_folder, embeddings):
+    # Rewrites an index.faiss/index.pkl store in the mmap layout, keeping chunk order and sources
+    search_index = FAISS.load_local(legacy_folder, embeddings)
+    ntotal = search_index.index.ntotal
+    vectors = search_index.index.reconstruct_n(0, ntotal)
+    documents = [search_index.docstore.search(search_index.index_to_docstore_id[i]) for i in range(ntotal)]
+    write_mmap_index(index_folder, documents, vectors)
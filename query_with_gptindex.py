@@ -1,32 +1,39 @@
 import openai
+import shutil
+import tempfile
 from gpt_index import GPTSimpleVectorIndex, SimpleDirectoryReader
 from cloud_storage import *
 
 
 def querying_with_gptindex(uuid_number, query):
-    files_count = read_given_file(uuid_number, "index.json")
-    if files_count:
-        index = GPTSimpleVectorIndex.load_from_disk("index.json")
-        try:
-            response = index.query(query)
-            source_node = response.source_nodes
-            source_text = ""
-            if len(source_node):
-                source_text = source_node[0].source_text
-            os.remove("index.json")
-            return str(response).strip(), source_text.strip(), None, 200
-        except openai.error.RateLimitError as e:
-            error_message = f"OpenAI API request exceeded rate limit: {e}"
-            status_code = 500
-        except (openai.error.APIError, openai.error.ServiceUnavailableError):
-            error_message = "Server is overloaded or unable to answer your request at the moment. Please try again later"
-            status_code = 503
-        except Exception as e:
-            error_message = str(e.__context__) + " and " + e.__str__()
-            status_code = 500
-    else:
-        error_message = "The UUID number is incorrect"
-        status_code = 422
+    # Each query downloads the index into its own folder, since queries run concurrently on the worker's thread pool
+    temp_folder = tempfile.mkdtemp(prefix="gptindex-")
+    index_path = os.path.join(temp_folder, "index.json")
+    try:
+        files_count = read_given_file(uuid_number, "index.json", index_path)
+        if files_count:
+            index = GPTSimpleVectorIndex.load_from_disk(index_path)
+            try:
+                response = index.query(query)
+                source_node = response.source_nodes
+                source_text = ""
+                if len(source_node):
+                    source_text = source_node[0].source_text
+                return str(response).strip(), source_text.strip(), None, 200
+            except openai.error.RateLimitError as e:
+                error_message = f"OpenAI API request exceeded rate limit: {e}"
+                status_code = 500
+            except (openai.error.APIError, openai.error.ServiceUnavailableError):
+                error_message = "Server is overloaded or unable to answer your request at the moment. Please try again later"
+                status_code = 503
+            except Exception as e:
+                error_message = str(e.__context__) + " and " + e.__str__()
+                status_code = 500
+        else:
+            error_message = "The UUID number is incorrect"
+            status_code = 422
+    finally:
+        shutil.rmtree(temp_folder, ignore_errors=True)
     return None, None, error_message, status_code
 
 
@@ -1,4 +1,6 @@
+import asyncio
 import logging
+import threading
 import openai
 from gpt_index import SimpleDirectoryReader
 from langchain.chains.qa_with_sources import load_qa_with_sources_chain
@@ -7,8 +9,14 @@ from langchain.embeddings.openai import OpenAIEmbeddings
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.vectorstores import FAISS
 from langchain import PromptTemplate, OpenAI, LLMChain
+from fastapi.responses import Response
+from sse_starlette.sse import EventSourceResponse
 from cloud_storage import *
+from index_registry import load_search_index
+from embedding_cache import CachedEmbeddings
+from mmap_index import append_mmap_index, convert_legacy_index, is_mmap_index, read_index_meta, write_mmap_index
 import shutil
+import tempfile
 import json
 import csv
 from io import StringIO
@@ -26,22 +34,61 @@ logger = logging.getLogger('jugalbandi_api')
 promptsInMemoryDomainQues = []
 promptsInMemoryTechQues = []
 
+STREAM_FLUSH_INTERVAL = float(os.environ.get("STREAM_FLUSH_INTERVAL", 0.05))
+_STREAM_END = object()
 
 
 
-def langchain_indexing(uuid_number):
-    sources = SimpleDirectoryReader(uuid_number, recursive=True).load_data()
+
+def split_documents(documents_folder, first_source=0):
+    sources = SimpleDirectoryReader(documents_folder, recursive=True).load_data()
     source_chunks = []
     splitter = RecursiveCharacterTextSplitter(chunk_size=4 * 1024, chunk_overlap=200)
-    counter = 0
+    counter = first_source
     for source in sources:
         for chunk in splitter.split_text(source.text):
             new_metadata = {"source": str(counter)}
             source_chunks.append(Document(page_content=chunk, metadata=new_metadata))
             counter += 1
+    return source_chunks
+
+
+def langchain_indexing(documents_folder, index_folder, index_type="flat"):
+    source_chunks = split_documents(documents_folder)
+    if not source_chunks:
+        return "No text could be extracted from the uploaded files", 422
     try:
-        search_index = FAISS.from_documents(source_chunks, OpenAIEmbeddings())
-        search_index.save_local("")
+        vectors = CachedEmbeddings(OpenAIEmbeddings()).embed_documents([chunk.page_content for chunk in source_chunks])
+        write_mmap_index(index_folder, source_chunks, vectors, index_type)
+        error_message = None
+        status_code = 200
+    except openai.error.RateLimitError as e:
+        error_message = f"OpenAI API request exceeded rate limit: {e}"
+        status_code = 500
+    except (openai.error.APIError, openai.error.ServiceUnavailableError):
+        error_message = "Server is overloaded or unable to answer your request at the moment. Please try again later"
+        status_code = 503
+    except Exception as e:
+        error_message = str(e.__context__) + " and " + e.__str__()
+        status_code = 500
+    return error_message, status_code
+
+
+def langchain_append_indexing(documents_folder, existing_index_folder, index_folder):
+    if not is_mmap_index(existing_index_folder):
+        # Stores indexed before the mmap layout are converted once, on their first append
+        converted_folder = tempfile.mkdtemp(prefix="converted-", dir=os.path.dirname(index_folder))
+        convert_legacy_index(existing_index_folder, converted_folder, OpenAIEmbeddings())
+        existing_index_folder = converted_folder
+    # Sources are numbered by insertion order, so new chunks continue after the last stored one
+    start = read_index_meta(existing_index_folder)["ntotal"]
+    source_chunks = split_documents(documents_folder, first_source=start)
+    if not source_chunks:
+        return "No text could be extracted from the uploaded files", 422
+    try:
+        embeddings = CachedEmbeddings(OpenAIEmbeddings())
+        vectors = embeddings.embed_documents([chunk.page_content for chunk in source_chunks])
+        append_mmap_index(existing_index_folder, index_folder, source_chunks, vectors)
         error_message = None
         status_code = 200
     except openai.error.RateLimitError as e:
@@ -69,42 +116,38 @@ def rephrased_question(user_query):
 
 
 def querying_with_langchain(uuid_number, query):
-    files_count = read_langchain_index_files(uuid_number)
-    if files_count == 2:
-        try:
-            search_index = FAISS.load_local(uuid_number, OpenAIEmbeddings())
-            chain = load_qa_with_sources_chain(
-                OpenAI(temperature=0), chain_type="map_reduce"
-            )
-            paraphrased_query = rephrased_question(query)
-            documents = search_index.similarity_search(paraphrased_query, k=5)
-            answer = chain(
-                {"input_documents": documents, "question": paraphrased_query}
-            )
-            answer_list = answer["output_text"].split("\nSOURCES:")
-            final_answer = answer_list[0].strip()
-            source_ids = answer_list[1]
-            source_ids = source_ids.replace(" ", "")
-            source_ids = source_ids.replace(".", "")
-            source_ids = source_ids.split(",")
-            final_source_text = ""
-            for document in documents:
-                if document.metadata["source"] in source_ids:
-                    final_source_text += document.page_content + "\n\n"
-            shutil.rmtree(uuid_number)
-            return final_answer, final_source_text, paraphrased_query, None, 200
-        except openai.error.RateLimitError as e:
-            error_message = f"OpenAI API request exceeded rate limit: {e}"
-            status_code = 500
-        except (openai.error.APIError, openai.error.ServiceUnavailableError):
-            error_message = "Server is overloaded or unable to answer your request at the moment. Please try again later"
-            status_code = 503
-        except Exception as e:
-            error_message = str(e.__context__) + " and " + e.__str__()
-            status_code = 500
-    else:
-        error_message = "The UUID number is incorrect"
-        status_code = 422
+    try:
+        search_index = load_search_index(uuid_number)
+        if search_index is None:
+            return None, None, None, "The UUID number is incorrect", 422
+        chain = load_qa_with_sources_chain(
+            OpenAI(temperature=0), chain_type="map_reduce"
+        )
+        paraphrased_query = rephrased_question(query)
+        documents = search_index.similarity_search(paraphrased_query, k=5)
+        answer = chain(
+            {"input_documents": documents, "question": paraphrased_query}
+        )
+        answer_list = answer["output_text"].split("\nSOURCES:")
+        final_answer = answer_list[0].strip()
+        source_ids = answer_list[1]
+        source_ids = source_ids.replace(" ", "")
+        source_ids = source_ids.replace(".", "")
+        source_ids = source_ids.split(",")
+        final_source_text = ""
+        for document in documents:
+            if document.metadata["source"] in source_ids:
+                final_source_text += document.page_content + "\n\n"
+        return final_answer, final_source_text, paraphrased_query, None, 200
+    except openai.error.RateLimitError as e:
+        error_message = f"OpenAI API request exceeded rate limit: {e}"
+        status_code = 500
+    except (openai.error.APIError, openai.error.ServiceUnavailableError):
+        error_message = "Server is overloaded or unable to answer your request at the moment. Please try again later"
+        status_code = 503
+    except Exception as e:
+        error_message = str(e.__context__) + " and " + e.__str__()
+        status_code = 500
     return None, None, None, error_message, status_code
 
 
@@ -131,86 +174,130 @@ def querying_with_langchain_gpt4(uuid_number, query):
             status_code = 500
         return None, None, None, error_message, status_code
     else:
-        files_count = read_langchain_index_files(uuid_number)
-        if files_count == 2:
-            try:
-                search_index = FAISS.load_local(uuid_number, OpenAIEmbeddings())
-                documents = search_index.similarity_search(query, k=5)
-                contexts = [document.page_content for document in documents]
-                augmented_query = "\n\n---\n\n".join(contexts) + "\n\n-----\n\n" + query
-                system_rules = "You are a helpful assistant who helps with answering questions based on the provided information. If the information cannot be found in the text provided, you admit that I don't know"
-
-                res = openai.ChatCompletion.create(
-                    model="gpt-4",
-                    messages=[
-                        {"role": "system", "content": system_rules},
-                        {"role": "user", "content": augmented_query},
-                    ],
-                )
-                return res["choices"][0]["message"]["content"], "", "", None, 200
-
-            except openai.error.RateLimitError as e:
-                error_message = f"OpenAI API request exceeded rate limit: {e}"
-                status_code = 500
-            except (openai.error.APIError, openai.error.ServiceUnavailableError):
-                error_message = "Server is overloaded or unable to answer your request at the moment. Please try again later"
-                status_code = 503
-            except Exception as e:
-                error_message = str(e.__context__) + " and " + e.__str__()
-                status_code = 500
-        else:
-            error_message = "The UUID number is incorrect"
-            status_code = 422
-        return None, None, None, error_message, status_code
-
-def querying_with_langchain_gpt4_streaming(uuid_number, query):
-    files_count = read_langchain_index_files(uuid_number)
-    if files_count == 2:
         try:
-            search_index = FAISS.load_local(uuid_number, OpenAIEmbeddings())
+            search_index = load_search_index(uuid_number)
+            if search_index is None:
+                return None, None, None, "The UUID number is incorrect", 422
             documents = search_index.similarity_search(query, k=5)
             contexts = [document.page_content for document in documents]
             augmented_query = "\n\n---\n\n".join(contexts) + "\n\n-----\n\n" + query
-
             system_rules = "You are a helpful assistant who helps with answering questions based on the provided information. If the information cannot be found in the text provided, you admit that I don't know"
-        
-            response = openai.ChatCompletion.create(
-                model='gpt-4',
+
+            res = openai.ChatCompletion.create(
+                model="gpt-4",
                 messages=[
                     {"role": "system", "content": system_rules},
-                    {"role": "user", "content": augmented_query}
+                    {"role": "user", "content": augmented_query},
                 ],
-                stream=True
             )
-
-            # Define a generator function to yield each chunk of the response
-            async def generate_messages():
-                for chunk in response:
-                    print(chunk)
-                    # chunk_message = chunk['choices'][0]['delta']['content']
-                    # chunk_message = chunk["choices"][0].get("delta", {}).get("content", '')
-                    chunk_message = chunk["choices"][0].get("delta", {}).get("content", '')
-                    yield chunk_message
-
-            # Return a StreamingResponse with the generated messages
-            return EventSourceResponse(generate_messages(), headers={"Content-Type":"text/plain"})
-            # application/json
+            return res["choices"][0]["message"]["content"], "", "", None, 200
 
         except openai.error.RateLimitError as e:
             error_message = f"OpenAI API request exceeded rate limit: {e}"
             status_code = 500
-            logger.exception("RateLimitError occurred: %s", e)
         except (openai.error.APIError, openai.error.ServiceUnavailableError):
             error_message = "Server is overloaded or unable to answer your request at the moment. Please try again later"
             status_code = 503
-            logger.exception("APIError or ServiceUnavailableError occurred")
         except Exception as e:
             error_message = str(e.__context__) + " and " + e.__str__()
             status_code = 500
-            logger.exception("An exception occurred: %s", e)
-    else:
-        error_message = "The UUID number is incorrect"
-        status_code = 422
+        return None, None, None, error_message, status_code
+
+def stream_chat_completion(response):
+    # The OpenAI stream is a blocking iterator, so it is drained on its own thread and handed to the
+    # event loop through a queue. Tokens are coalesced into one SSE frame per STREAM_FLUSH_INTERVAL,
+    # except for the first one which is sent as soon as it arrives.
+    async def generate_messages():
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        stop = threading.Event()
+
+        def put(item):
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+            except RuntimeError:
+                stop.set()
+
+        def consume():
+            try:
+                for chunk in response:
+                    if stop.is_set():
+                        break
+                    chunk_message = chunk["choices"][0].get("delta", {}).get("content", '')
+                    if chunk_message:
+                        put(chunk_message)
+            except Exception as e:
+                logger.exception("Streaming from OpenAI failed: %s", e)
+            finally:
+                put(_STREAM_END)
+
+        threading.Thread(target=consume, name="openai-stream", daemon=True).start()
+        pending = []
+        flush_at = None
+        first_sent = False
+        try:
+            while True:
+                timeout = None if flush_at is None else max(flush_at - loop.time(), 0)
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    yield "".join(pending)
+                    pending = []
+                    flush_at = None
+                    continue
+                if item is _STREAM_END:
+                    break
+                pending.append(item)
+                if not first_sent or STREAM_FLUSH_INTERVAL <= 0:
+                    yield "".join(pending)
+                    pending = []
+                    first_sent = True
+                elif flush_at is None:
+                    flush_at = loop.time() + STREAM_FLUSH_INTERVAL
+            if pending:
+                yield "".join(pending)
+        finally:
+            stop.set()
+
+    return generate_messages()
+
+
+def querying_with_langchain_gpt4_streaming(uuid_number, query):
+    try:
+        search_index = load_search_index(uuid_number)
+        if search_index is None:
+            return Response(content="The UUID number is incorrect", media_type="text/plain", status_code=422)
+        documents = search_index.similarity_search(query, k=5)
+        contexts = [document.page_content for document in documents]
+        augmented_query = "\n\n---\n\n".join(contexts) + "\n\n-----\n\n" + query
+
+        system_rules = "You are a helpful assistant who helps with answering questions based on the provided information. If the information cannot be found in the text provided, you admit that I don't know"
+    
+        response = openai.ChatCompletion.create(
+            model='gpt-4',
+            messages=[
+                {"role": "system", "content": system_rules},
+                {"role": "user", "content": augmented_query}
+            ],
+            stream=True
+        )
+
+        # Return a StreamingResponse with the generated messages
+        return EventSourceResponse(stream_chat_completion(response), headers={"Content-Type":"text/plain"})
+        # application/json
+
+    except openai.error.RateLimitError as e:
+        error_message = f"OpenAI API request exceeded rate limit: {e}"
+        status_code = 500
+        logger.exception("RateLimitError occurred: %s", e)
+    except (openai.error.APIError, openai.error.ServiceUnavailableError):
+        error_message = "Server is overloaded or unable to answer your request at the moment. Please try again later"
+        status_code = 503
+        logger.exception("APIError or ServiceUnavailableError occurred")
+    except Exception as e:
+        error_message = str(e.__context__) + " and " + e.__str__()
+        status_code = 500
+        logger.exception("An exception occurred: %s", e)
 
     # return None, None, None, error_message, status_codewss
     # If there's an error, return a plain text response with the error message
@@ -246,98 +333,37 @@ def querying_with_langchain_gpt4_mcq(uuid_number, query, doCache):
         return None, None, None, error_message, status_code
     else:
         logger.info('************** Domain Specific **************')
-        files_count = read_langchain_index_files(uuid_number)
-        if files_count == 2:
-            try:
-                search_index = FAISS.load_local(uuid_number, OpenAIEmbeddings())
-                documents = search_index.similarity_search(query, k=5)
-                contexts = [document.page_content for document in documents]
-
-                system_rules = getSystemRulesForDomainSpecificQuestions()
-                context = "\n\n---\n\n".join(contexts) + "\n\n-----\n\n"
-                system_rules = system_rules.format(Context=context)
-
-                prompts = getPromptsForGCP(doCache, query, system_rules,  promptsInMemoryDomainQues)
-                logger.info(prompts)
-                start_time = time.time()
-                res = openai.ChatCompletion.create(
-                    model="gpt-3.5-turbo-16k",
-                    messages = promptsInMemoryDomainQues if doCache else prompts,
-                )
-                end_time = time.time() - start_time
-                logger.info(f"********* TOTAL TIME TOOK **********>>>>> {end_time}")
-                respMsg = res["choices"][0]["message"]["content"]
-                logger.info('************** Questions **************')
-                logger.info(respMsg)    
-                if doCache:
-                    promptsInMemoryDomainQues.append({"role":"assistant", "content":respMsg})
-
-                csvOutout = jsnoDifferenceData(uuid_number, respMsg) # JSON based duplication solution
-                # csvOutout = csvDifferenceData(uuid_number, respMsg) # CSV based duplication solution
-                logger.info('---- Filtered Questions-----')
-                logger.info(csvOutout)
-                return csvOutout, "", "", None, 200
-
-            except openai.error.RateLimitError as e:
-                error_message = f"OpenAI API request exceeded rate limit: {e}"
-                status_code = 500
-            except (openai.error.APIError, openai.error.ServiceUnavailableError):
-                error_message = "Server is overloaded or unable to answer your request at the moment. Please try again later"
-                status_code = 503
-            except Exception as e:
-                # error_message = str(e.__context__) + " and " + e.__str__()
-                error_message = e.__str__()
-                status_code = 500
-        else:
-            error_message = "The UUID number is incorrect"
-            status_code = 422
-        return None, None, None, error_message, status_code
-
-def querying_with_langchain_gpt3(uuid_number, query):
-    files_count = read_langchain_index_files(uuid_number)
-    if files_count == 2:
         try:
-            search_index = FAISS.load_local(uuid_number, OpenAIEmbeddings())
-            documents = search_index.similarity_search_with_score(query, k=5)
-            logger.info('========== FAISS: Similarity Search indexed the documents ===========')
-            logger.info(documents)
-            # contexts = [document.page_content for document in documents]
-            contexts =  [document.page_content for document, search_score in documents if search_score < 0.45]
-            if not contexts:
-                return "I'm sorry, but I don't have enough information to provide a specific answer for your question. Please provide more information or context about what you are referring to.", "", "", None, 200
-            
-            contexts = "\n\n---\n\n".join(contexts) + "\n\n-----\n\n"
-            system_rules = """You are a friendly assistant to the user who can provide clear and accurate responses to user's questions. 
-            Engage users in a friendly and approachable manner, Provide correct and up-to-date information that are clear, concise, and easy to understand. 
-            If applicable, direct users to relevant website pages or resources for further information. If the user has additional questions, continue the conversation to assist further. 
-            If a question is beyond your capabilities, inform the user that they may need to refer to the sunbird microsite or forums for further details. 
-            Conclude the conversation with a friendly message when the user no longer needs assistance.
-            Very Important: 
-                - If the question is about writing code use backticks (```) at the front and end of the code snippet and include the language use after the first ticks.
-                - If the anwser conatains single line code use <code> at the front and use </code> end of the code snippet.
-            If you don't know the answer, just say you don't know. DO NOT try to make up an answer.
-            If the question is not related to the context, politely respond that you are tuned to only answer questions that are related to the context. 
-            When responding to questions that require a summarized answer, please ensure the summary remains concise and accurate, limiting it to no more than 100 words while capturing the essential key points
-            When facing questions that necessitate simplified answers, make sure the simplification remains concise, accurately encompassing the vital points within a 100-word limit.
-            
-            Given the following context:
-            
-            {context}
-
-            All answers should be in MARKDOWN (.md) Format:"""
-
-            system_rules = system_rules.format(context=contexts)
-
-            print("system_rulessystem_rule =======> ", system_rules)
+            search_index = load_search_index(uuid_number)
+            if search_index is None:
+                return None, None, None, "The UUID number is incorrect", 422
+            documents = search_index.similarity_search(query, k=5)
+            contexts = [document.page_content for document in documents]
+
+            system_rules = getSystemRulesForDomainSpecificQuestions()
+            context = "\n\n---\n\n".join(contexts) + "\n\n-----\n\n"
+            system_rules = system_rules.format(Context=context)
 
+            prompts = getPromptsForGCP(doCache, query, system_rules,  promptsInMemoryDomainQues)
+            logger.info(prompts)
+            start_time = time.time()
             res = openai.ChatCompletion.create(
                 model="gpt-3.5-turbo-16k",
-                messages=[
-                    {"role": "system", "content": system_rules},
-                    {"role": "user", "content": query},
-                ],
+                messages = promptsInMemoryDomainQues if doCache else prompts,
             )
-            return res["choices"][0]["message"]["content"], str(documents), "", None, 200
+            end_time = time.time() - start_time
+            logger.info(f"********* TOTAL TIME TOOK **********>>>>> {end_time}")
+            respMsg = res["choices"][0]["message"]["content"]
+            logger.info('************** Questions **************')
+            logger.info(respMsg)    
+            if doCache:
+                promptsInMemoryDomainQues.append({"role":"assistant", "content":respMsg})
+
+            csvOutout = jsnoDifferenceData(uuid_number, respMsg) # JSON based duplication solution
+            # csvOutout = csvDifferenceData(uuid_number, respMsg) # CSV based duplication solution
+            logger.info('---- Filtered Questions-----')
+            logger.info(csvOutout)
+            return csvOutout, "", "", None, 200
 
         except openai.error.RateLimitError as e:
             error_message = f"OpenAI API request exceeded rate limit: {e}"
@@ -346,31 +372,72 @@ def querying_with_langchain_gpt3(uuid_number, query):
             error_message = "Server is overloaded or unable to answer your request at the moment. Please try again later"
             status_code = 503
         except Exception as e:
-            error_message = str(e.__context__) + " and " + e.__str__()
+            # error_message = str(e.__context__) + " and " + e.__str__()
+            error_message = e.__str__()
             status_code = 500
-    else:
-        error_message = "The UUID number is incorrect"
-        status_code = 422
-    return None, None, None, error_message, status_code
-        
-# User feedback
-async def record_user_feedback(engine, qa_id, feedback_type):
+        return None, None, None, error_message, status_code
+
+def querying_with_langchain_gpt3(uuid_number, query, query_embedding=None):
     try:
-       async with engine.acquire() as connection:
-            record_exists = await connection.fetchval("SELECT id FROM sb_qa_logs WHERE question_id = $1", qa_id)
-            if record_exists is not None:
-                if feedback_type.lower() == "up":
-                    await connection.execute("UPDATE sb_qa_logs SET upvotes = upvotes + 1 WHERE question_id = $1", qa_id)
-                elif feedback_type.lower() == "down":
-                    await connection.execute("UPDATE sb_qa_logs SET downvotes = downvotes + 1 WHERE question_id = $1", qa_id)
-                return 'OK', None, 200
-            else:
-                 return None, f"Record with ID {qa_id} not found", 404
+        search_index = load_search_index(uuid_number)
+        if search_index is None:
+            return None, None, None, "The UUID number is incorrect", 422
+        if query_embedding is None:
+            documents = search_index.similarity_search_with_score(query, k=5)
+        else:
+            documents = search_index.similarity_search_with_score_by_vector(query_embedding, k=5)
+        logger.info('========== FAISS: Similarity Search indexed the documents ===========')
+        logger.info(documents)
+        # contexts = [document.page_content for document in documents]
+        contexts =  [document.page_content for document, search_score in documents if search_score < 0.45]
+        if not contexts:
+            return "I'm sorry, but I don't have enough information to provide a specific answer for your question. Please provide more information or context about what you are referring to.", "", "", None, 200
+        
+        contexts = "\n\n---\n\n".join(contexts) + "\n\n-----\n\n"
+        system_rules = """You are a friendly assistant to the user who can provide clear and accurate responses to user's questions. 
+        Engage users in a friendly and approachable manner, Provide correct and up-to-date information that are clear, concise, and easy to understand. 
+        If applicable, direct users to relevant website pages or resources for further information. If the user has additional questions, continue the conversation to assist further. 
+        If a question is beyond your capabilities, inform the user that they may need to refer to the sunbird microsite or forums for further details. 
+        Conclude the conversation with a friendly message when the user no longer needs assistance.
+        Very Important: 
+            - If the question is about writing code use backticks (```) at the front and end of the code snippet and include the language use after the first ticks.
+            - If the anwser conatains single line code use <code> at the front and use </code> end of the code snippet.
+        If you don't know the answer, just say you don't know. DO NOT try to make up an answer.
+        If the question is not related to the context, politely respond that you are tuned to only answer questions that are related to the context. 
+        When responding to questions that require a summarized answer, please ensure the summary remains concise and accurate, limiting it to no more than 100 words while capturing the essential key points
+        When facing questions that necessitate simplified answers, make sure the simplification remains concise, accurately encompassing the vital points within a 100-word limit.
+        
+        Given the following context:
+        
+        {context}
+
+        All answers should be in MARKDOWN (.md) Format:"""
+
+        system_rules = system_rules.format(context=contexts)
+
+        print("system_rulessystem_rule =======> ", system_rules)
+
+        res = openai.ChatCompletion.create(
+            model="gpt-3.5-turbo-16k",
+            messages=[
+                {"role": "system", "content": system_rules},
+                {"role": "user", "content": query},
+            ],
+        )
+        # The retrieved (document, score) pairs are returned as is; the caller logs them as chunk references
+        return res["choices"][0]["message"]["content"], documents, "", None, 200
+
+    except openai.error.RateLimitError as e:
+        error_message = f"OpenAI API request exceeded rate limit: {e}"
+        status_code = 500
+    except (openai.error.APIError, openai.error.ServiceUnavailableError):
+        error_message = "Server is overloaded or unable to answer your request at the moment. Please try again later"
+        status_code = 503
     except Exception as e:
         error_message = str(e.__context__) + " and " + e.__str__()
         status_code = 500
-        print(f"Error while giving feedback: {e}")
-        return None, error_message, status_code
+    return None, None, None, error_message, status_code
+
 
 def create_directory_from_filepath(filepath):
     directory_path = os.path.dirname(filepath)
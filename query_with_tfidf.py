@@ -1,64 +1,287 @@
 import PyPDF2
 from fastapi import HTTPException
 from sklearn.feature_extraction.text import TfidfVectorizer
+from scipy.sparse import csr_matrix
 from cloud_storage import *
 import re
 import csv
+import fcntl
+import hashlib
+import json
+import shutil
+import signal
+import logging
+import multiprocessing
+import pickle
+import sys
+import threading
+import time
+import uuid
 import numpy as np
 from io_processing import process_incoming_voice
 
+logger = logging.getLogger('jugalbandi_api')
+
+TITLES_CSV = os.environ.get("TITLES_CSV", "Titles.csv")
+TFIDF_INDEX_DIR = os.environ.get("TFIDF_INDEX_DIR", "tfidf_index")
+# How often a worker checks for a new title index or an edited Titles.csv
+TFIDF_RELOAD_SECONDS = int(os.environ.get("TFIDF_RELOAD_SECONDS", 30))
+TFIDF_CURRENT_FILE = "CURRENT"
+TFIDF_LOCK_FILE = ".lock"
+TFIDF_BATCH_MAX_QUERIES = int(os.environ.get("TFIDF_BATCH_MAX_QUERIES", 1000))
+TITLE_EXTRACTION_WORKERS = int(os.environ.get("TITLE_EXTRACTION_WORKERS", os.cpu_count() or 1))
+# Seconds a single PDF may take before its title is left empty
+TITLE_EXTRACTION_TIMEOUT = int(os.environ.get("TITLE_EXTRACTION_TIMEOUT", 60))
+
+
+TITLE_STOP_WORDS = ["arrangementofsections", "sections", "section", "arrengementofsections", "arrengementofsection",
+                    "arrangmentofsections", "arrangementofsection",
+                    "arrngementofsections", "arrangamentofsections", "arrangementsofsections", "arrengmentofsections",
+                    "arrangmentofsection", "arrangaemntofsections",
+                    "arrangementsections", "arramgememtofsections", "arrangementsofsection", "contents", "1shorttitle",
+                    "statement"]
+TITLES_CSV_HEADERS = ["Document Name", "Document Title", "Document Public Url", "Content Hash"]
+
+
+def extract_title(file_path):
+    final_title = ""
+    with open(file_path, "rb") as file:
+        pdf_reader = PyPDF2.PdfReader(file)
+        page_one = pdf_reader.pages[0].extract_text().strip()
+        page_one = page_one.split("\n")
+        page_one = [page for page in page_one if page]
+        titles = page_one[:10]
+        for title in titles:
+            new_string = re.sub('[^a-zA-Z0-9]', '', title.strip())
+            if new_string.lower() in TITLE_STOP_WORDS:
+                break
+            else:
+                final_title += title
+    return final_title
+
+
+def _raise_timeout(signum, frame):
+    raise TimeoutError("title extraction timed out")
+
+
+def _extract_title_with_timeout(file_path, timeout):
+    # Runs in a pool process; SIGALRM interrupts a PDF that takes too long to parse
+    signal.signal(signal.SIGALRM, _raise_timeout)
+    signal.alarm(timeout)
+    try:
+        return extract_title(file_path), None
+    except Exception as e:
+        return "", f"{e.__class__.__name__}: {e}"
+    finally:
+        signal.alarm(0)
+
+
+def file_content_hash(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def extract_titles(directory, titles_csv=TITLES_CSV, workers=TITLE_EXTRACTION_WORKERS,
+                   timeout=TITLE_EXTRACTION_TIMEOUT):
+    # Returns one Titles.csv row per file. Files whose content hash is already in titles_csv keep their
+    # row from there; only new or changed files are parsed, in parallel over a pool of processes.
+    known_rows = {}
+    if os.path.exists(titles_csv):
+        with open(titles_csv, newline="", encoding="utf-8-sig") as csvfile:
+            for row in csv.DictReader(csvfile):
+                # Rows without a title are extracted again, in case the last attempt failed or timed out
+                if row.get("Content Hash") and row.get("Document Title"):
+                    known_rows[row["Content Hash"]] = row
+    rows = []
+    pending = []
+    for filename in os.listdir(directory):
+        content_hash = file_content_hash(os.path.join(directory, filename))
+        known_row = known_rows.get(content_hash)
+        rows.append({"Document Name": filename,
+                     "Document Title": known_row["Document Title"] if known_row else "",
+                     "Document Public Url": known_row["Document Public Url"] if known_row else "",
+                     "Content Hash": content_hash})
+        if known_row is None:
+            pending.append(rows[-1])
+    logger.info(f"Extracting titles of {len(pending)} files, {len(rows) - len(pending)} unchanged")
+    if pending:
+        with multiprocessing.get_context("spawn").Pool(min(workers, len(pending))) as pool:
+            results = [pool.apply_async(_extract_title_with_timeout, (os.path.join(directory, row["Document Name"]),
+                                                                      timeout))
+                       for row in pending]
+            for row, result in zip(pending, results):
+                try:
+                    # Backstop for a parse stuck outside Python code; leaving the pool terminates it
+                    row["Document Title"], error_message = result.get(timeout + 30)
+                except multiprocessing.TimeoutError:
+                    error_message = "title extraction timed out"
+                if error_message is not None:
+                    logger.warning(f"Title extraction failed for {row['Document Name']}: {error_message}")
+    return rows
+
 
 def get_title(directory):
-    files_list = os.listdir(directory)
-    stop_words = ["arrangementofsections", "sections", "section", "arrengementofsections", "arrengementofsection",
-                  "arrangmentofsections", "arrangementofsection",
-                  "arrngementofsections", "arrangamentofsections", "arrangementsofsections", "arrengmentofsections",
-                  "arrangmentofsection", "arrangaemntofsections",
-                  "arrangementsections", "arramgememtofsections", "arrangementsofsection", "contents", "1shorttitle",
-                  "statement"]
-    titles_list = []
-    for filename in files_list:
-        final_title = ""
-        with open(directory + "/" + filename, "rb") as file:
-            pdf_reader = PyPDF2.PdfReader(file)
-            page_one = pdf_reader.pages[0].extract_text().strip()
-            page_one = page_one.split("\n")
-            page_one = [page for page in page_one if page]
-            titles = page_one[:10]
-            for title in titles:
-                new_string = re.sub('[^a-zA-Z0-9]', '', title.strip())
-                if new_string.lower() in stop_words:
-                    break
-                else:
-                    final_title += title
-        titles_list.append(final_title)
-    return titles_list
+    return [row["Document Title"] for row in extract_titles(directory)]
 
 
 def tfidf_indexing(directory):
-    files_list = os.listdir(directory)
-    titles_list = []
-    with open("titles.txt", "r") as file:
-        for line in file:
-            titles_list.append(line.strip())
-
-    headers = ["Document Name", "Document Title", "Document Public Url"]
-    with open("Titles.csv", "w", newline="") as file:
-        writer = csv.DictWriter(file, fieldnames=headers)
+    rows = extract_titles(directory)
+    with open(TITLES_CSV, "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=TITLES_CSV_HEADERS)
         writer.writeheader()
-        for i in range(len(files_list)):
-            writer.writerow(
-                {"Document Name": files_list[0], "Document Title": titles_list[0], "Document Public Url": ""})
+        writer.writerows(rows)
+    build_tfidf_index()
 
 
-def querying_with_tfidf(query, input_language, audio_file):
+def read_titles(titles_csv=TITLES_CSV):
     titles_map = {}
-    with open("Titles.csv", newline="") as csvfile:
+    with open(titles_csv, newline="", encoding="utf-8-sig") as csvfile:
         reader = csv.DictReader(csvfile)
         for row in reader:
             titles_map[row["Document Title"]] = row["Document Public Url"]
-    titles_list = list(titles_map.keys())
+    return titles_map
+
+
+def titles_fingerprint(titles_csv=TITLES_CSV):
+    with open(titles_csv, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class _IndexDirLock:
+    # Serializes index builds between all processes on the node
+    def __init__(self, index_dir):
+        os.makedirs(index_dir, exist_ok=True)
+        self.path = os.path.join(index_dir, TFIDF_LOCK_FILE)
+
+    def __enter__(self):
+        self._file = open(self.path, "w")
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+
+
+def _read_current(index_dir):
+    try:
+        with open(os.path.join(index_dir, TFIDF_CURRENT_FILE)) as f:
+            version = f.read().strip()
+    except FileNotFoundError:
+        return None
+    return version if os.path.isdir(os.path.join(index_dir, version)) else None
 
+
+def _version_number(version):
+    # Versions are named <counter>-<fingerprint prefix>; anything else in the directory is not a version
+    number = version.split("-", 1)[0]
+    return int(number) if number.isdigit() else None
+
+
+def build_tfidf_index(titles_csv=TITLES_CSV, index_dir=TFIDF_INDEX_DIR):
+    with _IndexDirLock(index_dir):
+        return _build_tfidf_index(titles_csv, index_dir)
+
+
+def ensure_tfidf_index(titles_csv=TITLES_CSV, index_dir=TFIDF_INDEX_DIR):
+    # Returns the current version, building one first if there is none or Titles.csv has changed since.
+    # Workers that wait on the lock while another one builds find the fresh version and do not build again.
+    fingerprint = titles_fingerprint(titles_csv)
+    with _IndexDirLock(index_dir):
+        version = _read_current(index_dir)
+        if version is not None:
+            with open(os.path.join(index_dir, version, "titles.json")) as f:
+                if json.load(f).get("fingerprint") == fingerprint:
+                    return version
+        return os.path.basename(_build_tfidf_index(titles_csv, index_dir))
+
+
+def _build_tfidf_index(titles_csv, index_dir):
+    # Fits the vectorizer once and saves it with the title matrix as raw CSR arrays in a new version
+    # folder; CURRENT is then switched to it atomically, so workers never load a half-written index.
+    # Must be called with the index directory lock held.
+    fingerprint = titles_fingerprint(titles_csv)
+    titles_map = read_titles(titles_csv)
+    vectorizer = TfidfVectorizer(dtype=np.float32)
+    tfidf_matrix = vectorizer.fit_transform(list(titles_map.keys())).tocsr()
+    versions = [entry.name for entry in os.scandir(index_dir)
+                if entry.is_dir() and _version_number(entry.name) is not None]
+    previous_version = _read_current(index_dir)
+    version = f"{max(map(_version_number, versions), default=0) + 1:08d}-{fingerprint[:12]}"
+    version_folder = os.path.join(index_dir, version)
+    os.makedirs(version_folder)
+    with open(os.path.join(version_folder, "vectorizer.pkl"), "wb") as f:
+        pickle.dump(vectorizer, f)
+    np.save(os.path.join(version_folder, "matrix_data.npy"), tfidf_matrix.data)
+    np.save(os.path.join(version_folder, "matrix_indices.npy"), tfidf_matrix.indices)
+    np.save(os.path.join(version_folder, "matrix_indptr.npy"), tfidf_matrix.indptr)
+    with open(os.path.join(version_folder, "titles.json"), "w") as f:
+        json.dump({"shape": tfidf_matrix.shape, "titles": list(titles_map.items()), "fingerprint": fingerprint}, f)
+    current_temp = os.path.join(index_dir, TFIDF_CURRENT_FILE + ".tmp-" + uuid.uuid4().hex)
+    with open(current_temp, "w") as f:
+        f.write(version)
+    os.replace(current_temp, os.path.join(index_dir, TFIDF_CURRENT_FILE))
+    # Keep the previous version for workers that have not reloaded yet
+    for old_version in versions:
+        if old_version not in (version, previous_version):
+            shutil.rmtree(os.path.join(index_dir, old_version), ignore_errors=True)
+    logger.info(f"Built TF-IDF title index {version}")
+    return version_folder
+
+
+class TfidfTitleIndex:
+    def __init__(self, version_folder):
+        with open(os.path.join(version_folder, "vectorizer.pkl"), "rb") as f:
+            self.vectorizer = pickle.load(f)
+        with open(os.path.join(version_folder, "titles.json")) as f:
+            titles = json.load(f)
+        self.titles = [title for title, _ in titles["titles"]]
+        self.urls = [url for _, url in titles["titles"]]
+        self.matrix = csr_matrix((np.load(os.path.join(version_folder, "matrix_data.npy"), mmap_mode="r"),
+                                  np.load(os.path.join(version_folder, "matrix_indices.npy"), mmap_mode="r"),
+                                  np.load(os.path.join(version_folder, "matrix_indptr.npy"), mmap_mode="r")),
+                                 shape=tuple(titles["shape"]), copy=False)
+
+    def search(self, query, k=3):
+        return self.search_batch([query], k)[0]
+
+    def search_batch(self, queries, k=3):
+        # One sparse transform and one sparse product for all queries; only the k best titles per query are sorted
+        cosine_similarities = (self.vectorizer.transform(queries) @ self.matrix.T).toarray()
+        k = min(k, cosine_similarities.shape[1])
+        top_indices = np.argpartition(cosine_similarities, -k, axis=1)[:, -k:]
+        rows = np.arange(len(queries))[:, None]
+        top_indices = np.take_along_axis(top_indices, np.argsort(-cosine_similarities[rows, top_indices], axis=1),
+                                         axis=1)
+        return [[(self.titles[i], self.urls[i], round(float(cosine_similarities[row, i]), 2)) for i in indices]
+                for row, indices in enumerate(top_indices)]
+
+
+_title_index = None
+_title_index_version = None
+_title_index_checked_at = 0
+_title_index_lock = threading.Lock()
+
+
+def get_title_index():
+    global _title_index, _title_index_version, _title_index_checked_at
+    if _title_index is not None and time.time() - _title_index_checked_at < TFIDF_RELOAD_SECONDS:
+        return _title_index
+    with _title_index_lock:
+        # Builds the index when this node has none yet, or when Titles.csv was edited since it was built
+        version = ensure_tfidf_index()
+        if version != _title_index_version:
+            _title_index = TfidfTitleIndex(os.path.join(TFIDF_INDEX_DIR, version))
+            _title_index_version = version
+            logger.info(f"Loaded TF-IDF title index {version}")
+        _title_index_checked_at = time.time()
+        return _title_index
+
+
+def querying_with_tfidf(query, input_language, audio_file):
     if query == "":
         regional_text, english_text, error_message = process_incoming_voice(audio_file, input_language)
         if english_text is None:
@@ -67,13 +290,18 @@ def querying_with_tfidf(query, input_language, audio_file):
             print(english_text)
             query = english_text
 
-    vectorizer = TfidfVectorizer()
-    tfidf_matrix = vectorizer.fit_transform(titles_list)
-    title_vector = vectorizer.transform([query])
-    cosine_similarities = tfidf_matrix.dot(title_vector.T).toarray().flatten()
-    top_3_indices = np.argsort(cosine_similarities)[-3:][::-1]
-    answer_list = []
-    for i in top_3_indices:
-        title = titles_list[i]
-        answer_list.append((title, titles_map[title], round(cosine_similarities[i], 2)))
-    return answer_list
+    return get_title_index().search(query, k=3)
+
+
+def querying_with_tfidf_batch(queries, k=3):
+    return get_title_index().search_batch(queries, k)
+
+
+if __name__ == "__main__":
+    # python query_with_tfidf.py [documents directory | Titles.csv] builds the title index served by
+    # /source-document, extracting the titles of a documents directory into Titles.csv first
+    if len(sys.argv) > 1 and os.path.isdir(sys.argv[1]):
+        tfidf_indexing(sys.argv[1])
+        print("Built TF-IDF title index from", sys.argv[1])
+    else:
+        print("Built TF-IDF title index", build_tfidf_index(*sys.argv[1:2]))
@@ -0,0 +1,165 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from cachetools import TTLCache
+
+logger = logging.getLogger('jugalbandi_api')
+
+# sqlite shares one cache between the workers of a node; memory keeps a separate cache in every worker
+RESPONSE_CACHE_BACKEND = os.environ.get("RESPONSE_CACHE_BACKEND", "sqlite")
+RESPONSE_CACHE_MAXSIZE = int(os.environ.get("RESPONSE_CACHE_MAXSIZE", 100))
+RESPONSE_CACHE_PATH = os.environ.get("RESPONSE_CACHE_PATH", "response_cache.sqlite3")
+CACHE_TTL = int(os.environ.get("CACHE_TTL", 86400))
+# How often a worker writes its buffered hit/miss counts and access times to the SQLite cache
+RESPONSE_CACHE_FLUSH_INTERVAL = float(os.environ.get("RESPONSE_CACHE_FLUSH_INTERVAL", 10))
+
+
+# Cache local to one worker process
+class InMemoryResponseCache:
+    def __init__(self, maxsize, ttl):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, uuid_number, key):
+        with self._lock:
+            value = self._cache.get((uuid_number, key))
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def set(self, uuid_number, key, value):
+        with self._lock:
+            self._cache[(uuid_number, key)] = value
+
+    def invalidate(self, uuid_number):
+        with self._lock:
+            for cache_key in [cache_key for cache_key in self._cache.keys() if cache_key[0] == uuid_number]:
+                self._cache.pop(cache_key, None)
+
+    def stats(self):
+        with self._lock:
+            return {"backend": "memory", "entries": len(self._cache), "hits": self.hits, "misses": self.misses}
+
+
+# Cache shared by every worker on the node through one SQLite file
+class SQLiteResponseCache:
+    def __init__(self, path, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript('''
+            CREATE TABLE IF NOT EXISTS response_cache (
+                uuid_number TEXT NOT NULL,
+                cache_key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                PRIMARY KEY (uuid_number, cache_key)
+            );
+            CREATE INDEX IF NOT EXISTS response_cache_accessed_at_idx ON response_cache (accessed_at);
+            CREATE TABLE IF NOT EXISTS response_cache_stats (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+            INSERT OR IGNORE INTO response_cache_stats (name, value) VALUES ('hits', 0), ('misses', 0);
+        ''')
+        self._pending_hits = 0
+        self._pending_misses = 0
+        self._pending_accesses = {}
+        self._flushed_at = time.time()
+
+    def get(self, uuid_number, key):
+        # Reads are plain SELECTs; the counters and LRU access times are buffered and written in batches
+        now = time.time()
+        try:
+            with self._lock:
+                row = self._connection.execute(
+                    "SELECT value FROM response_cache WHERE uuid_number = ? AND cache_key = ? AND expires_at > ?",
+                    (uuid_number, key, now)).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"Response cache read failed, treating it as a miss: {e}")
+            row = None
+        with self._lock:
+            if row is None:
+                self._pending_misses += 1
+            else:
+                self._pending_hits += 1
+                self._pending_accesses[(uuid_number, key)] = now
+        self._flush_pending()
+        return None if row is None else json.loads(row[0])
+
+    def set(self, uuid_number, key, value):
+        # Access times are written first so the LRU eviction below sees this worker's recent reads
+        self._flush_pending(force=True)
+        now = time.time()
+        try:
+            with self._lock, self._connection:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO response_cache (uuid_number, cache_key, value, expires_at, accessed_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (uuid_number, key, json.dumps(value), now + self.ttl, now))
+                self._connection.execute("DELETE FROM response_cache WHERE expires_at <= ?", (now,))
+                overflow = self._connection.execute("SELECT COUNT(*) FROM response_cache").fetchone()[0] - self.maxsize
+                if overflow > 0:
+                    self._connection.execute(
+                        "DELETE FROM response_cache WHERE rowid IN "
+                        "(SELECT rowid FROM response_cache ORDER BY accessed_at LIMIT ?)", (overflow,))
+        except sqlite3.Error as e:
+            logger.warning(f"Response cache write failed, the response is not cached: {e}")
+
+    def _flush_pending(self, force=False):
+        with self._lock:
+            if not force and time.time() - self._flushed_at < RESPONSE_CACHE_FLUSH_INTERVAL:
+                return
+            self._flushed_at = time.time()
+            if not (self._pending_hits or self._pending_misses or self._pending_accesses):
+                return
+            try:
+                with self._connection:
+                    self._connection.executemany(
+                        "UPDATE response_cache SET accessed_at = MAX(accessed_at, ?) "
+                        "WHERE uuid_number = ? AND cache_key = ?",
+                        [(accessed_at, uuid_number, key)
+                         for (uuid_number, key), accessed_at in self._pending_accesses.items()])
+                    self._connection.execute("UPDATE response_cache_stats SET value = value + ? WHERE name = 'hits'",
+                                             (self._pending_hits,))
+                    self._connection.execute("UPDATE response_cache_stats SET value = value + ? WHERE name = 'misses'",
+                                             (self._pending_misses,))
+            except sqlite3.Error as e:
+                # The buffered values are kept and written with the next flush
+                logger.warning(f"Writing response cache statistics failed: {e}")
+                return
+            self._pending_hits = 0
+            self._pending_misses = 0
+            self._pending_accesses = {}
+
+    def invalidate(self, uuid_number):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM response_cache WHERE uuid_number = ?", (uuid_number,))
+
+    def stats(self):
+        self._flush_pending(force=True)
+        with self._lock:
+            counters = dict(self._connection.execute("SELECT name, value FROM response_cache_stats").fetchall())
+            entries = self._connection.execute("SELECT COUNT(*) FROM response_cache").fetchone()[0]
+            # Counts of a failed flush are still buffered in this worker
+            return {"backend": "sqlite", "entries": entries, "hits": counters["hits"] + self._pending_hits,
+                    "misses": counters["misses"] + self._pending_misses}
+
+
+def create_response_cache():
+    if RESPONSE_CACHE_BACKEND == "sqlite":
+        return SQLiteResponseCache(RESPONSE_CACHE_PATH, RESPONSE_CACHE_MAXSIZE, CACHE_TTL)
+    if RESPONSE_CACHE_BACKEND == "memory":
+        return InMemoryResponseCache(RESPONSE_CACHE_MAXSIZE, CACHE_TTL)
+    raise ValueError(f"Unknown RESPONSE_CACHE_BACKEND '{RESPONSE_CACHE_BACKEND}'")
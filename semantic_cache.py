@@ -0,0 +1,111 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from langchain.embeddings.openai import OpenAIEmbeddings
+
+logger = logging.getLogger('jugalbandi_api')
+
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", 0.95))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.environ.get("SEMANTIC_CACHE_MAX_ENTRIES", 500))
+SEMANTIC_CACHE_MAX_UUIDS = int(os.environ.get("SEMANTIC_CACHE_MAX_UUIDS", 100))
+# Seconds an answer is served from the cache. An append only invalidates the cache of the worker that
+# handled it, so this bounds how long the other workers keep serving answers from before the append.
+SEMANTIC_CACHE_TTL = int(os.environ.get("SEMANTIC_CACHE_TTL", 600))
+
+_query_embeddings = None
+
+
+def embed_query(query):
+    global _query_embeddings
+    if _query_embeddings is None:
+        _query_embeddings = OpenAIEmbeddings()
+    return _query_embeddings.embed_query(query)
+
+
+# Previously answered queries of one document store, grown on demand and overwritten oldest first once full
+class _SemanticStore:
+    def __init__(self, max_entries, dimension):
+        self.max_entries = max_entries
+        self.vectors = np.zeros((min(16, max_entries), dimension), dtype=np.float32)
+        self.added_at = np.zeros(len(self.vectors))
+        self.values = []
+        self.next_position = 0
+
+    def lookup(self, vector, oldest):
+        # Entries added before oldest have expired and never match
+        if not self.values:
+            return None, 0.0
+        similarities = self.vectors[:len(self.values)] @ vector
+        similarities[self.added_at[:len(self.values)] < oldest] = -np.inf
+        best = int(np.argmax(similarities))
+        return self.values[best], float(similarities[best])
+
+    def add(self, vector, value, added_at):
+        if len(self.values) < self.max_entries:
+            if len(self.values) == len(self.vectors):
+                size = min(2 * len(self.vectors), self.max_entries)
+                grown = np.zeros((size, self.vectors.shape[1]), dtype=np.float32)
+                grown[:len(self.vectors)] = self.vectors
+                self.vectors = grown
+                self.added_at = np.concatenate([self.added_at, np.zeros(size - len(self.added_at))])
+            position = len(self.values)
+            self.values.append(value)
+        else:
+            position = self.next_position
+            self.values[position] = value
+            self.next_position = (self.next_position + 1) % self.max_entries
+        self.vectors[position] = vector
+        self.added_at[position] = added_at
+
+
+# Per-worker cache answering a query with the stored answer of a near-identical earlier query
+class SemanticCache:
+    def __init__(self, threshold, max_entries, max_uuids, ttl):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.max_uuids = max_uuids
+        self.ttl = ttl
+        self._stores = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, uuid_number, embedding):
+        vector = _normalize(embedding)
+        with self._lock:
+            store = self._stores.get(uuid_number)
+            if store is None or store.vectors.shape[1] != len(vector):
+                return None
+            self._stores.move_to_end(uuid_number)
+            value, similarity = store.lookup(vector, time.time() - self.ttl)
+        if value is not None and similarity >= self.threshold:
+            logger.info(f"Semantic cache hit for {uuid_number} with similarity {similarity:.4f}")
+            return value
+        return None
+
+    def add(self, uuid_number, embedding, value):
+        vector = _normalize(embedding)
+        with self._lock:
+            store = self._stores.get(uuid_number)
+            if store is None or store.vectors.shape[1] != len(vector):
+                store = _SemanticStore(self.max_entries, len(vector))
+                self._stores[uuid_number] = store
+            self._stores.move_to_end(uuid_number)
+            store.add(vector, value, time.time())
+            while len(self._stores) > self.max_uuids:
+                self._stores.popitem(last=False)
+
+    def invalidate(self, uuid_number):
+        with self._lock:
+            self._stores.pop(uuid_number, None)
+
+
+def _normalize(embedding):
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+semantic_cache = SemanticCache(SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_MAX_ENTRIES, SEMANTIC_CACHE_MAX_UUIDS,
+                               SEMANTIC_CACHE_TTL)
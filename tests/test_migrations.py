@@ -0,0 +1,110 @@
+import asyncio
+import os
+import uuid
+from datetime import datetime
+
+import asyncpg
+import pytest
+import pytz
+
+import database_functions
+
+# Runs against the PostgreSQL server named by the DATABASE_* variables; each test uses a scratch database
+pytestmark = pytest.mark.skipif(not os.getenv("DATABASE_IP"), reason="DATABASE_IP is not set")
+
+
+def connection_args(database):
+    return dict(host=os.getenv("DATABASE_IP"), port=os.getenv("DATABASE_PORT"), user=os.getenv("DATABASE_USERNAME"),
+                password=os.getenv("DATABASE_PASSWORD"), database=database)
+
+
+@pytest.fixture
+def scratch_database(monkeypatch):
+    name = f"migration_test_{uuid.uuid4().hex}"
+    maintenance_database = os.getenv("DATABASE_NAME") or "postgres"
+
+    async def run(query):
+        connection = await asyncpg.connect(**connection_args(maintenance_database))
+        try:
+            await connection.execute(query)
+        finally:
+            await connection.close()
+
+    asyncio.run(run(f"CREATE DATABASE {name}"))
+    monkeypatch.setenv("DATABASE_NAME", name)
+    yield name
+    asyncio.run(run(f"DROP DATABASE IF EXISTS {name} WITH (FORCE)"))
+
+
+async def applied_versions(engine):
+    return [record["version"] for record in await engine.fetch("SELECT version FROM schema_migrations ORDER BY 1")]
+
+
+async def partitions(engine, table):
+    records = await engine.fetch("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                                 "WHERE i.inhparent = $1::regclass", table)
+    return {record["relname"] for record in records}
+
+
+def test_migrations_apply_to_an_empty_database(scratch_database):
+    async def run():
+        engine = await database_functions.create_engine()
+        try:
+            assert await applied_versions(engine) == [version for version, _, _ in database_functions.MIGRATIONS]
+            now = datetime.now(pytz.UTC)
+            for table in database_functions.LOG_PARTITIONED_TABLES:
+                assert f"{table}_{now:%Y%m}" in await partitions(engine, table) or \
+                    f"{table}_before_{database_functions.month_start(now, 1):%Y%m}" in await partitions(engine, table)
+
+            log_writer = database_functions.LogWriter(engine)
+            await database_functions.insert_qa_logs(log_writer, "langchain", "store", "query", None, "response",
+                                                    None, None)
+            await database_functions.insert_sb_qa_logs(log_writer, "gpt-3.5-turbo", "store", "question", "query",
+                                                       None, "response", None, None, [("1", "chunk text", 0.5)])
+            await log_writer.flush()
+            assert log_writer.written == 3 and log_writer.failed == 0
+            assert await engine.fetchval("SELECT COUNT(*) FROM qa_logs") == 1
+            assert await engine.fetchval("SELECT COUNT(*) FROM document_chunks") == 1
+            assert await engine.fetchval("SELECT query_count FROM usage_rollups WHERE uuid_number = 'store'") == 2
+
+            # A second start finds every migration applied and changes nothing
+            await engine.close()
+            engine = await database_functions.create_engine()
+            assert await applied_versions(engine) == [version for version, _, _ in database_functions.MIGRATIONS]
+        finally:
+            await engine.close()
+
+    asyncio.run(run())
+
+
+def test_partitioning_keeps_rows_of_an_existing_database(scratch_database):
+    async def run():
+        # A database created before the log tables were partitioned, with migrations 1 and 2 applied
+        migrations = database_functions.MIGRATIONS
+        database_functions.MIGRATIONS = migrations[:2]
+        try:
+            engine = await database_functions.create_engine()
+        finally:
+            database_functions.MIGRATIONS = migrations
+        try:
+            await engine.execute("INSERT INTO qa_logs (uuid_number, query) VALUES ('store', 'old query')")
+            await engine.execute("INSERT INTO sb_qa_logs (uuid_number, question_id, query) "
+                                 "VALUES ('store', 'question', 'old query')")
+        finally:
+            await engine.close()
+
+        engine = await database_functions.create_engine()
+        try:
+            assert await applied_versions(engine) == [version for version, _, _ in migrations]
+            next_month = database_functions.month_start(datetime.now(pytz.UTC), 1)
+            assert f"sb_qa_logs_before_{next_month:%Y%m}" in await partitions(engine, "sb_qa_logs")
+            assert await engine.fetchval("SELECT query FROM qa_logs WHERE uuid_number = 'store'") == "old query"
+            # New rows continue the id sequence of the converted table
+            await engine.execute("INSERT INTO qa_logs (uuid_number, query) VALUES ('store', 'new query')")
+            assert await engine.fetchval("SELECT MAX(id) FROM qa_logs") == 2
+            assert await database_functions.record_user_feedback(engine, "question", "up") == ("OK", None, 200)
+            assert await engine.fetchval("SELECT upvotes FROM sb_qa_logs WHERE question_id = 'question'") == 1
+        finally:
+            await engine.close()
+
+    asyncio.run(run())
@@ -1,11 +1,90 @@
 import json
 import base64
+import hashlib
+import io
 import os
+import subprocess
+import threading
+import wave
 import requests
-from pydub import AudioSegment
+from cachetools import LRUCache
 from google.cloud import texttospeech, speech, translate
+from requests.adapters import HTTPAdapter
 from urllib.parse import urlparse
 
+TRANSLATION_HTTP_POOL_SIZE = int(os.environ.get("TRANSLATION_HTTP_POOL_SIZE", 16))
+TRANSLATION_CACHE_SIZE = int(os.environ.get("TRANSLATION_CACHE_SIZE", 10000))
+AUDIO_SAMPLE_RATE = 16000
+AUDIO_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+AUDIO_DOWNLOAD_TIMEOUT = int(os.environ.get("AUDIO_DOWNLOAD_TIMEOUT", 60))
+AUDIO_DECODE_TIMEOUT = int(os.environ.get("AUDIO_DECODE_TIMEOUT", 120))
+
+_http_session = None
+_google_clients = {}
+_clients_lock = threading.Lock()
+
+
+# One keep-alive connection pool per worker for the ai4bharat APIs, instead of a handshake per call
+def get_http_session():
+    global _http_session
+    if _http_session is None:
+        with _clients_lock:
+            if _http_session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=TRANSLATION_HTTP_POOL_SIZE,
+                                      pool_maxsize=TRANSLATION_HTTP_POOL_SIZE)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _http_session = session
+    return _http_session
+
+
+# Google API clients are thread-safe and expensive to build, so each one is created once per worker
+def get_google_client(client_class):
+    client = _google_clients.get(client_class)
+    if client is None:
+        with _clients_lock:
+            client = _google_clients.get(client_class)
+            if client is None:
+                client = client_class()
+                _google_clients[client_class] = client
+    return client
+
+
+# Translations keyed by (text hash, source, destination); cached answers are translated to the
+# same languages again and again
+class TranslationCache:
+    def __init__(self, maxsize):
+        self._cache = LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(text, source, destination):
+        return hashlib.sha256(text.encode("utf-8")).hexdigest(), source, destination
+
+    def get(self, text, source, destination):
+        with self._lock:
+            value = self._cache.get(self.key(text, source, destination))
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def set(self, text, source, destination, translated_text):
+        with self._lock:
+            self._cache[self.key(text, source, destination)] = translated_text
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._cache), "maxsize": self._cache.maxsize, "hits": self.hits,
+                    "misses": self.misses}
+
+
+translation_cache = TranslationCache(TRANSLATION_CACHE_SIZE)
+
 def is_url(string):
     try:
         result = urlparse(string)
@@ -13,29 +92,46 @@ def is_url(string):
     except ValueError:
         return False
 
-def get_encoded_string(url):
-    if is_url(url):
-        local_filename = "local_file.mp3"
-        with requests.get(url) as r:
-            with open(local_filename, 'wb') as f:
-                f.write(r.content)
+def download_audio(url):
+    # Streams the audio into memory; nothing is written to disk
+    buffer = io.BytesIO()
+    with get_http_session().get(url, stream=True, timeout=AUDIO_DOWNLOAD_TIMEOUT) as r:
+        r.raise_for_status()
+        for chunk in r.iter_content(chunk_size=AUDIO_DOWNLOAD_CHUNK_SIZE):
+            buffer.write(chunk)
+    return buffer.getvalue()
+
+
+def decode_audio(audio_bytes):
+    # ffmpeg reads the original audio on stdin and writes 16kHz mono 16-bit PCM on stdout
+    process = subprocess.run(
+        ["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", "pipe:0",
+         "-ac", "1", "-ar", str(AUDIO_SAMPLE_RATE), "-f", "s16le", "-acodec", "pcm_s16le", "pipe:1"],
+        input=audio_bytes, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=AUDIO_DECODE_TIMEOUT)
+    if process.returncode != 0:
+        raise RuntimeError("Audio decoding failed: " + process.stderr.decode(errors="ignore").strip())
+    wav_buffer = io.BytesIO()
+    with wave.open(wav_buffer, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(AUDIO_SAMPLE_RATE)
+        wav_file.writeframes(process.stdout)
+    return wav_buffer.getvalue()
+
+
+def get_wav_content(audio):
+    # audio is the uploaded audio as bytes, a URL to download it from, or a local file path
+    if isinstance(audio, (bytes, bytearray)):
+        audio_bytes = bytes(audio)
+    elif is_url(audio):
+        audio_bytes = download_audio(audio)
     else:
-        local_filename = url
-
-    given_audio = AudioSegment.from_file(local_filename)
-    given_audio = given_audio.set_frame_rate(16000)
-    given_audio = given_audio.set_channels(1)
-    given_audio.export("temp.wav", format="wav", codec="pcm_s16le")
-    with open("temp.wav", "rb") as wav_file:
-        wav_file_content = wav_file.read()
-    encoded_string = base64.b64encode(wav_file_content)
-    encoded_string = str(encoded_string, 'ascii', 'ignore')
-    os.remove(local_filename)
-    os.remove("temp.wav")
-    return encoded_string, wav_file_content
+        with open(audio, "rb") as audio_file:
+            audio_bytes = audio_file.read()
+    return decode_audio(audio_bytes)
 
 def google_speech_to_text(wav_file_content, input_language):
-    client = speech.SpeechClient()
+    client = get_google_client(speech.SpeechClient)
     audio = speech.RecognitionAudio(content=wav_file_content)
     language_code = input_language + "-IN"
     config = speech.RecognitionConfig(
@@ -56,12 +152,12 @@ def speech_to_text(encoded_string, input_language):
             "audio": [{"audioContent": encoded_string}]
             }
     api_url = "https://asr-api.ai4bharat.org/asr/v1/recognize/" + input_language
-    response = requests.post(api_url, data=json.dumps(data))
+    response = get_http_session().post(api_url, data=json.dumps(data))
     text = json.loads(response.text)["output"][0]["source"]
     return text
 
 def google_translate_text(text, source, destination, project_id="indian-legal-bert"):
-    client = translate.TranslationServiceClient()
+    client = get_google_client(translate.TranslationServiceClient)
     location = "global"
     parent = f"projects/{project_id}/locations/{location}"
     response = client.translate_text(
@@ -76,6 +172,9 @@ def google_translate_text(text, source, destination, project_id="indian-legal-be
     return response.translations[0].translated_text
 
 def indic_translation(text, source, destination):
+    translated_text = translation_cache.get(text, source, destination)
+    if translated_text is not None:
+        return translated_text
     try:
         data = {
             "source_language": source,
@@ -83,15 +182,16 @@ def indic_translation(text, source, destination):
             "text": text
         }
         api_url = "https://nmt-api.ai4bharat.org/translate_sentence"
-        response = requests.post(api_url, data=json.dumps(data), timeout=60)
-        indic_text = json.loads(response.text)
+        response = get_http_session().post(api_url, data=json.dumps(data), timeout=60)
+        translated_text = json.loads(response.text)['text']
     except:
-        indic_text = google_translate_text(text, source, destination)
-    return indic_text['text']
+        translated_text = google_translate_text(text, source, destination)
+    translation_cache.set(text, source, destination, translated_text)
+    return translated_text
 
 def google_text_to_speech(text, language):
     try:
-        client = texttospeech.TextToSpeechClient()
+        client = get_google_client(texttospeech.TextToSpeechClient)
         input_text = texttospeech.SynthesisInput(text=text)
         voice = texttospeech.VoiceSelectionParams(
             language_code=language,
@@ -112,17 +212,19 @@ def text_to_speech(language, text, gender='female'):
     try:
         api_url = "https://tts-api.ai4bharat.org/"
         payload = {"input": [{"source": text}], "config": {"gender": gender, "language": {"sourceLanguage": language}}}
-        response = requests.post(api_url, json=payload, timeout=60)
+        response = get_http_session().post(api_url, json=payload, timeout=60)
         audio_content = response.json()['audio'][0]['audioContent']
         audio_content = base64.b64decode(audio_content)
     except:
         audio_content = google_text_to_speech(text, language)
     return audio_content
 
-def audio_input_to_text(audio_file, input_language):
-    encoded_string, wav_file_content = get_encoded_string(audio_file)
+def audio_input_to_text(audio, input_language):
+    wav_file_content = get_wav_content(audio)
     try:
         indic_text = google_speech_to_text(wav_file_content, input_language)
     except:
+        # Only the AI4Bharat API takes base64, so the audio is encoded just for this fallback
+        encoded_string = base64.b64encode(wav_file_content).decode("ascii")
         indic_text = speech_to_text(encoded_string, input_language)
     return indic_text
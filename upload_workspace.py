@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+from zipfile import ZipFile
+
+UPLOAD_WORKSPACE_DIR = os.environ.get("UPLOAD_WORKSPACE_DIR") or None
+UPLOAD_CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_SIZE", 1024 * 1024))
+
+
+# Every upload request gets its own temporary workspace: uploaded files, extracted archives,
+# the documents to index and the index artifacts all live there, never in the process CWD.
+class UploadWorkspace:
+    def __init__(self):
+        self.path = tempfile.mkdtemp(prefix="upload-", dir=UPLOAD_WORKSPACE_DIR)
+        self.documents_folder = os.path.join(self.path, "documents")
+        self.index_folder = os.path.join(self.path, "index")
+        os.makedirs(self.documents_folder)
+        os.makedirs(self.index_folder)
+
+    async def save_upload(self, file):
+        # Streams the upload to disk in fixed-size chunks instead of reading it into memory
+        upload_path = os.path.join(self.path, os.path.basename(file.filename))
+        with open(upload_path, 'wb') as f:
+            while True:
+                chunk = await file.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+        return upload_path
+
+    def add_document(self, upload_path):
+        file_name = os.path.basename(upload_path)
+        shutil.move(upload_path, self.document_path(file_name))
+        return [file_name]
+
+    def extract_archive(self, archive_path):
+        archive_folder = tempfile.mkdtemp(prefix="archive-", dir=self.path)
+        with ZipFile(archive_path, 'r') as zip_ref:
+            zip_ref.extractall(archive_folder)
+        bad_zip_folder = os.path.join(archive_folder, "__MACOSX")
+        if os.path.exists(bad_zip_folder):
+            shutil.rmtree(bad_zip_folder)
+        archived_files = os.listdir(archive_folder)
+        for archived_file in archived_files:
+            shutil.move(os.path.join(archive_folder, archived_file), self.document_path(archived_file))
+        shutil.rmtree(archive_folder)
+        os.remove(archive_path)
+        return archived_files
+
+    def document_path(self, file_name):
+        return os.path.join(self.documents_folder, file_name)
+
+    def index_path(self, file_name):
+        return os.path.join(self.index_folder, file_name)
+
+    def cleanup(self):
+        shutil.rmtree(self.path, ignore_errors=True)